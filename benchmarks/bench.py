@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of the sensor registry, a collection cycle, a discovery burst
+# and the Proxmox guest collector.
+#
+# Sensors run against a generated fixture tree instead of the real /proc, /sys,
+# /etc and /app/host, with a cgroup v2 tree of four containers and four VMs and
+# stub vcgencmd and zpool binaries first on the PATH, and publish to an
+# in-process stand-in for the MQTT client. No broker and no network are needed.
+# The results are printed as JSON so runs of different versions can be compared:
+#
+#   python3 benchmarks/bench.py --cycles 50 --output before.json
+#
+# All requirements of system_sensors (psutil, paho-mqtt, PyYAML) must be installed.
+
+import os
+import sys
+import json
+import time
+import shutil
+import builtins
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import statistics
+import concurrent.futures
+
+# Paths served from the fixture tree instead of the host
+REMAPPED = ['/proc', '/sys', '/etc', '/app/host', '/opt/vc']
+
+ROUTE = ('Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n'
+         'eth0\t00000000\t0100A8C0\t0003\t0\t0\t100\t00000000\t0\t0\t0\n'
+         'wlan0\t00000000\t0100A8C0\t0003\t0\t0\t600\t00000000\t0\t0\t0\n'
+         'eth0\t0000A8C0\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0\n'
+         'wlan0\t0000A8C0\t00000000\t0001\t0\t0\t600\t00FFFFFF\t0\t0\t0\n')
+FIB_TRIE = ''.join(f'{table}:\n'
+                   '  +-- 0.0.0.0/0 3 0 5\n     |-- 0.0.0.0\n        /0 universe UNICAST\n'
+                   '     +-- 127.0.0.0/8 2 0 2\n        |-- 127.0.0.1\n           /32 host LOCAL\n'
+                   '     +-- 192.168.0.0/24 2 0 2\n        |-- 192.168.0.0\n           /24 link UNICAST\n'
+                   '        |-- 192.168.0.2\n           /32 host LOCAL\n        |-- 192.168.0.3\n           /32 host LOCAL\n'
+                   for table in ['Main', 'Local'])
+
+FIXTURE = {
+    'etc/os-release': 'PRETTY_NAME="Raspbian GNU/Linux 12 (bookworm)"\nNAME="Raspbian GNU/Linux"\nVERSION_ID="12"\n'
+                      'VERSION="12 (bookworm)"\nID=raspbian\nID_LIKE=debian\n',
+    'app/host/os-release': 'PRETTY_NAME="Raspbian GNU/Linux 12 (bookworm)"\nNAME="Raspbian GNU/Linux"\nID=raspbian\n',
+    'app/host/hostname': 'benchpi\n',
+    'app/host/proc/device-tree/model': 'Raspberry Pi 4 Model B Rev 1.4\0',
+    'proc/net/route': ROUTE,
+    'proc/net/fib_trie': FIB_TRIE,
+    # The container reads the host's routing tables mounted from /proc/1/net
+    'app/host/proc/net/route': ROUTE,
+    'app/host/proc/net/fib_trie': FIB_TRIE,
+    'proc/meminfo': 'MemTotal:        3884420 kB\nMemFree:          812344 kB\nMemAvailable:    2731788 kB\n'
+                    'Buffers:          101232 kB\nCached:          1734188 kB\nSwapTotal:        102396 kB\n'
+                    'SwapFree:          91132 kB\n',
+    'proc/stat': 'cpu  61294 1323 20981 3217381 4352 0 1282 0 0 0\n'
+                 'cpu0 15329 331 5243 804302 1088 0 640 0 0 0\ncpu1 15321 330 5245 804360 1087 0 321 0 0 0\n'
+                 'cpu2 15322 331 5246 804359 1088 0 160 0 0 0\ncpu3 15322 331 5247 804360 1089 0 161 0 0 0\n'
+                 'intr 1 0\nctxt 9483712\nbtime 1760000000\nprocesses 61020\nprocs_running 1\nprocs_blocked 0\n',
+    'proc/cpuinfo': ''.join(f'processor\t: {cpu}\nBogoMIPS\t: 108.00\n\n' for cpu in range(4)) + 'Model\t\t: Raspberry Pi 4 Model B Rev 1.4\n',
+    'proc/loadavg': '0.42 0.37 0.30 1/312 61020\n',
+    'proc/diskstats': '   8       0 sda 41422 5370 3212970 20380 91530 60324 5891570 301040 0 145660 331870 0 0 0 0 0 0\n'
+                      '   8       1 sda1 41000 5370 3200000 20000 91000 60000 5800000 300000 0 145000 330000 0 0 0 0 0 0\n'
+                      ' 179       0 mmcblk0 8123 2311 712470 9170 3301 1933 81272 6230 0 10490 15400 0 0 0 0 0 0\n',
+    'proc/net/dev': 'Inter-|   Receive                                                |  Transmit\n'
+                    ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n'
+                    '    lo:  123456    1234    0    0    0     0          0         0   123456    1234    0    0    0     0       0          0\n'
+                    '  eth0: 98765432   76543    0    0    0     0          0       123 12345678   23456    0    0    0     0       0          0\n'
+                    ' wlan0: 45678901   34567    0    0    0     0          0         0  5678901   12345    0    0    0     0       0          0\n',
+    'proc/net/wireless': 'Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE\n'
+                         ' face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22\n'
+                         ' wlan0: 0000   58.  -52.  -256        0      0      0      0     37        0\n',
+    'proc/filesystems': 'nodev\tsysfs\nnodev\tproc\nnodev\ttmpfs\n\text4\n\tvfat\nnodev\tzfs\n',
+    'proc/self/mounts': '/dev/root / ext4 rw,noatime 0 0\n/dev/mmcblk0p1 /boot/firmware vfat rw,relatime 0 0\n'
+                        'tank /tank zfs rw,xattr,noacl 0 0\n',
+    'proc/self/mountinfo': '25 1 179:2 / / rw,noatime shared:1 - ext4 /dev/root rw\n'
+                           '30 25 179:1 / /boot/firmware rw,relatime shared:2 - vfat /dev/mmcblk0p1 rw\n'
+                           '41 25 0:45 / /tank rw,noatime shared:20 - zfs tank rw,xattr,noacl\n',
+    'sys/class/hwmon/hwmon0/name': 'cpu_thermal\n',
+    'sys/class/hwmon/hwmon0/temp1_input': '48200\n',
+    'sys/class/hwmon/hwmon1/name': 'pwmfan\n',
+    'sys/class/hwmon/hwmon1/fan1_input': '2400\n',
+    'sys/class/hwmon/hwmon2/name': 'rpi_volt\n',
+    'sys/class/hwmon/hwmon2/in0_lcrit_alarm': '0\n',
+    'sys/class/thermal/thermal_zone0/type': 'cpu-thermal\n',
+    'sys/class/thermal/thermal_zone0/temp': '48200\n',
+    **{f'sys/devices/system/cpu/cpufreq/policy0/scaling_{name}_freq': f'{value}\n'
+       for name, value in [('cur', 1500000), ('min', 600000), ('max', 1800000)]},
+}
+
+# Proxmox guests in a cgroup v2 tree, four LXC containers and four QEMU VMs
+GUESTS = {guest: ('lxc', f'sys/fs/cgroup/lxc/{guest}') for guest in range(100, 104)}
+GUESTS.update({guest: ('qemu', f'sys/fs/cgroup/qemu.slice/{guest}.scope') for guest in range(200, 204)})
+for guest, (kind, cgroup) in GUESTS.items():
+    FIXTURE[f'{cgroup}/cpu.stat'] = f'usage_usec {guest * 1000000}\nuser_usec {guest * 600000}\nsystem_usec {guest * 400000}\n'
+    FIXTURE[f'{cgroup}/memory.current'] = f'{guest * 1048576}\n'
+    FIXTURE[f'{cgroup}/memory.max'] = 'max\n' if guest % 2 else '1073741824\n'
+    FIXTURE[f'{cgroup}/io.stat'] = f'8:0 rbytes={guest * 4096} wbytes={guest * 8192} rios=10 wios=20 dbytes=0 dios=0\n'
+    if kind == 'lxc':
+        FIXTURE[f'etc/pve/lxc/{guest}.conf'] = f'arch: arm64\nhostname: ct{guest}\nmemory: 1024\n'
+    else:
+        FIXTURE[f'etc/pve/qemu-server/{guest}.conf'] = f'memory: 2048\nname: vm{guest}\n'
+
+STUBS = {
+    'bin/vcgencmd': 'echo display_power=1',
+    'opt/vc/bin/vcgencmd': 'echo display_power=1',
+    'bin/zpool': 'printf "tank\\t42\\nbackup\\t7\\n"',
+}
+
+def build_fixture(root):
+    for name, content in FIXTURE.items():
+        os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(content)
+    for name, command in STUBS.items():
+        os.makedirs(os.path.join(root, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(f'#!/bin/sh\n{command}\n')
+        os.chmod(os.path.join(root, name), 0o755)
+
+real_open = builtins.open
+forks = 0
+
+def install_fixture(root):
+    """Serve the remapped paths from root for the rest of the process, and count child processes."""
+    def remap(path):
+        if isinstance(path, int):
+            return path
+        name = os.fspath(path)
+        if isinstance(name, str) and any(name == prefix or name.startswith(prefix + '/') for prefix in REMAPPED):
+            return root + name
+        return path
+
+    def wrap(function):
+        def remapped(*args, **kwargs):
+            if args:
+                args = (remap(args[0]),) + args[1:]
+            return function(*args, **kwargs)
+        return remapped
+
+    builtins.open = wrap(builtins.open)
+    for name in ['open', 'stat', 'lstat', 'listdir', 'scandir', 'statvfs', 'access', 'readlink']:
+        setattr(os, name, wrap(getattr(os, name)))
+    os.environ['PATH'] = os.path.join(root, 'bin') + os.pathsep + os.environ['PATH']
+
+    execute_child = subprocess.Popen._execute_child
+    def counting_execute_child(self, args, *rest, **kwargs):
+        global forks
+        forks += 1
+        if isinstance(args, list):
+            args = [remap(args[0])] + args[1:]
+        return execute_child(self, args, *rest, **kwargs)
+    subprocess.Popen._execute_child = counting_execute_child
+
+class Client:
+    """Stands in for the paho client, counting what would go out on the wire."""
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = b'' if payload is None else payload.encode('utf-8') if isinstance(payload, str) else payload
+        self.messages += 1
+        self.bytes += len(topic.encode('utf-8')) + len(payload)
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+def rss_kb():
+    with real_open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+def distribution(samples, scale=1000):
+    samples = sorted(samples)
+    return {
+        'mean': round(statistics.fmean(samples) * scale, 3),
+        'p50': round(samples[len(samples) // 2] * scale, 3),
+        'p95': round(samples[max(0, -(-len(samples) * 95 // 100) - 1)] * scale, 3),
+        'max': round(samples[-1] * scale, 3),
+    }
+
+def setup(ss, args):
+    ss.settings = ss.set_defaults({
+        'devicename': 'bench',
+        'client_id': 'bench',
+        'timezone': 'UTC',
+        'mqtt': {'hostname': 'localhost'},
+        'workers': args.workers,
+        'discovery': args.discovery,
+        'per_sensor_topics': args.per_sensor_topics,
+        'guests': {'enabled': True},
+        'sensors': {
+            'power_status': False,
+            'updates': False,
+            'external_drives': {'tank': '/tank'},
+            'interfaces': ['eth0', 'wlan0'],
+            'disks': ['sda', 'mmcblk0'],
+        },
+    })
+    ss.check_settings(ss.settings)
+    ss.add_drives()
+    ss.add_interfaces_and_disks()
+    ss.add_sampled_sensors()
+    ss.devicename = 'bench'
+    ss.deviceNameDisplay = 'Bench'
+    ss.deviceManufacturer = 'RPI Foundation'
+    ss.deviceModel = ss.get_host_model()
+    ss.ha_status = 'hass'
+    ss.mqttClient = Client()
+    ss.connected.set()
+    if args.workers > 0:
+        ss.executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='sensor')
+
+def bench_sensors(ss, calls):
+    results = {}
+    for sensor in ss.enabled_sensors():
+        durations = []
+        start_forks = forks
+        errors = 0
+        for _ in range(calls):
+            ss.new_snapshot()
+            start = time.perf_counter()
+            try:
+                ss.read_sensor(sensor)
+            except Exception:
+                errors += 1
+            durations.append(time.perf_counter() - start)
+        results[sensor] = dict(distribution(durations, 1e6), forks_per_call=(forks - start_forks) / calls, errors=errors)
+    return results
+
+def bench_cycles(ss, cycles):
+    wall, cpu, cycle_forks, messages, sent = [], [], [], [], []
+    for _ in range(cycles):
+        start_forks, start_messages, start_bytes = forks, ss.mqttClient.messages, ss.mqttClient.bytes
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        ss.update_sensors()
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+        cycle_forks.append(forks - start_forks)
+        messages.append(ss.mqttClient.messages - start_messages)
+        sent.append(ss.mqttClient.bytes - start_bytes)
+    return {
+        'cycles': cycles,
+        'sensors': len(ss.periodic_sensors()),
+        'wall_ms': distribution(wall),
+        'cpu_ms': distribution(cpu),
+        'forks_per_cycle': statistics.fmean(cycle_forks),
+        'messages_per_cycle': statistics.fmean(messages),
+        'bytes_per_cycle': statistics.fmean(sent),
+        'rss_kb': rss_kb(),
+    }
+
+def bench_discovery(ss, bursts):
+    wall, cpu = [], []
+    for burst in range(bursts):
+        # The first burst builds the messages, later bursts send the cached ones
+        ss.retained_config.clear()
+        start_messages, start_bytes = ss.mqttClient.messages, ss.mqttClient.bytes
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        ss.send_config_message(ss.mqttClient)
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+    return {
+        'bursts': bursts,
+        'messages_per_burst': ss.mqttClient.messages - start_messages,
+        'bytes_per_burst': ss.mqttClient.bytes - start_bytes,
+        'cold': {'wall_ms': round(wall[0] * 1000, 3), 'cpu_ms': round(cpu[0] * 1000, 3)},
+        'wall_ms': distribution(wall),
+        'cpu_ms': distribution(cpu),
+    }
+
+def bench_guests(ss, passes):
+    wall, cpu, messages, sent = [], [], [], []
+    for _ in range(passes):
+        # The first pass finds the guests and sends their discovery messages, later passes only publish states
+        start_messages, start_bytes = ss.mqttClient.messages, ss.mqttClient.bytes
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        ss.update_guests()
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+        messages.append(ss.mqttClient.messages - start_messages)
+        sent.append(ss.mqttClient.bytes - start_bytes)
+    return {
+        'passes': passes,
+        'guests': len(ss.guest_values),
+        'cold': {'wall_ms': round(wall[0] * 1000, 3), 'cpu_ms': round(cpu[0] * 1000, 3),
+                 'messages': messages[0], 'bytes': sent[0]},
+        'wall_ms': distribution(wall[1:] or wall),
+        'cpu_ms': distribution(cpu[1:] or cpu),
+        'messages_per_pass': statistics.fmean(messages[1:] or messages),
+        'bytes_per_pass': statistics.fmean(sent[1:] or sent),
+    }
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Offline benchmark of system_sensors against a fixture filesystem')
+    parser.add_argument('--cycles', type=int, default=20, help='collection cycles to run')
+    parser.add_argument('--calls', type=int, default=50, help='calls of every sensor function')
+    parser.add_argument('--bursts', type=int, default=10, help='discovery bursts to send, the first one builds the messages')
+    parser.add_argument('--workers', type=int, default=4, help='worker threads, 0 reads sensors sequentially')
+    parser.add_argument('--discovery', choices=['entity', 'device'], default='entity')
+    parser.add_argument('--per-sensor-topics', action='store_true')
+    parser.add_argument('--container', action='store_true', help='run as if inside the docker container')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    return parser
+
+if __name__ == '__main__':
+    args = _parser().parse_args()
+    root = tempfile.mkdtemp(prefix='system-sensors-bench-')
+    try:
+        build_fixture(root)
+        install_fixture(root)
+        if args.container:
+            os.environ['YES_YOU_ARE_IN_A_CONTAINER'] = 'true'
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+        # Sensor output goes to stderr so stdout only holds the results
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            start = time.perf_counter()
+            import system_sensors as ss
+            import_time = time.perf_counter() - start
+            import_rss = rss_kb()
+            setup(ss, args)
+            results = {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'args': vars(args),
+                'import_ms': round(import_time * 1000, 3),
+                'import_rss_kb': import_rss,
+                'sensors_us': bench_sensors(ss, args.calls),
+                'cycle': bench_cycles(ss, args.cycles),
+                'discovery': bench_discovery(ss, args.bursts),
+                # Last, the guests add their devices to the discovery messages
+                'guests': bench_guests(ss, args.cycles),
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+        finally:
+            sys.stdout = stdout
+            if 'ss' in globals() and ss.executor is not None:
+                ss.executor.shutdown(wait=False)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with real_open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+# Fleet simulator: many virtual system_sensors hosts in one process against a real broker.
+#
+# Every virtual device has its own devicename and runs the real discovery, state
+# and deadband code of system_sensors on its own sensor schedule, with synthetic
+# values instead of the host's. Sensors with a sample_interval are sampled per
+# device into its own sample windows, which its statistics sensors report.
+# The devices share --connections MQTT connections, and with them the client id
+# the broker sees. Pass as many connections as devices to give every device its
+# own connection and client id, like a real fleet.
+# A separate observer connection plays Home Assistant: it receives everything the
+# devices publish, to measure end-to-end latency, and sends the HA birth message
+# that makes the whole fleet rediscover. Results are printed as JSON:
+#
+#   python3 benchmarks/fleet.py --devices 200 --connections 20 --duration 120 --host localhost
+#
+# Use --settings to simulate the fleet with a candidate settings.yaml. Point it at a
+# test broker, the retained messages of the devices are removed at the end unless
+# --keep is given. All requirements of system_sensors must be installed.
+
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import argparse
+import resource
+import threading
+import collections
+import datetime as dt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import paho.mqtt.client as mqtt
+from bench import distribution
+
+# Module globals of system_sensors that belong to one device, swapped in while it runs
+DEVICE_STATE = ['devicename', 'deviceNameDisplay', 'mqttClient', 'sensor_values', 'stale_sensors', 'in_flight',
+                'published_values', 'published_stale', 'last_publish', 'config_messages', 'config_key',
+                'retained_config', 'samplers']
+
+def message_kind(topic):
+    if topic.startswith('homeassistant/'):
+        return 'discovery'
+    if topic.endswith('/availability'):
+        return 'availability'
+    return 'state'
+
+def new_client(client_id):
+    # Same client versions as system_sensors supports
+    if not hasattr(mqtt, 'CallbackAPIVersion'):
+        return mqtt.Client(client_id=client_id)
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+
+class Stats:
+    """Counts and latencies of everything the fleet published, updated from the network threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = 'startup'
+        self.phase_start = {'startup': time.monotonic()}
+        self.messages = collections.Counter()
+        self.bytes = collections.Counter()
+        self.ack = []
+        self.delivery = []
+        # Per phase: discovery messages sent, and when the last one was acknowledged and delivered
+        self.storms = collections.defaultdict(lambda: {'messages': 0, 'acked': None, 'delivered': None})
+
+    def start_phase(self, phase):
+        with self.lock:
+            self.phase = phase
+            self.phase_start[phase] = time.monotonic()
+
+    def sent(self, kind, size):
+        with self.lock:
+            self.messages[kind] += 1
+            self.bytes[kind] += size
+            if kind == 'discovery':
+                self.storms[self.phase]['messages'] += 1
+            return self.phase
+
+    def acked(self, sent, kind, phase, now):
+        with self.lock:
+            self.ack.append(now - sent)
+            if kind == 'discovery':
+                self.storms[phase]['acked'] = now
+
+    def delivered(self, sent, kind, phase, now):
+        with self.lock:
+            self.delivery.append(now - sent)
+            if kind == 'discovery':
+                self.storms[phase]['delivered'] = now
+
+    def report(self, elapsed):
+        with self.lock:
+            storms = {}
+            for phase, storm in self.storms.items():
+                start = self.phase_start[phase]
+                storms[phase] = {
+                    'messages': storm['messages'],
+                    'acked_s': round(storm['acked'] - start, 3) if storm['acked'] else None,
+                    'delivered_s': round(storm['delivered'] - start, 3) if storm['delivered'] else None,
+                }
+            return {
+                'elapsed_s': round(elapsed, 3),
+                'messages': sum(self.messages.values()),
+                'bytes': sum(self.bytes.values()),
+                'messages_per_s': round(sum(self.messages.values()) / elapsed, 1),
+                'bytes_per_s': round(sum(self.bytes.values()) / elapsed, 1),
+                'by_kind': {kind: {'messages': self.messages[kind], 'bytes': self.bytes[kind],
+                                   'messages_per_s': round(self.messages[kind] / elapsed, 1),
+                                   'bytes_per_s': round(self.bytes[kind] / elapsed, 1)} for kind in self.messages},
+                'discovery_storms': storms,
+                'ack_ms': distribution(self.ack) if self.ack else None,
+                'delivery_ms': distribution(self.delivery) if self.delivery else None,
+            }
+
+class Connection:
+    """One broker connection shared by several devices, timing every QoS 1 message until its PUBACK."""
+    def __init__(self, client_id, args, stats, ha_status):
+        self.stats = stats
+        self.ha_status = ha_status
+        self.devices = {}
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        # mid -> (sent, kind, phase) until acknowledged, or mid -> acknowledged when the PUBACK won the race
+        self.unacked = {}
+        self.early = {}
+        self.sent_times = None
+        self.client = new_client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_publish = self.on_publish
+        self.client.on_message = self.on_message
+        if args.user:
+            self.client.username_pw_set(args.user, args.password)
+
+    def connect(self, host, port):
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, reason_code=0, properties=None):
+        if reason_code == 0:
+            client.subscribe(f'{self.ha_status}/status')
+            for device in self.devices.values():
+                device.subscribe()
+            self.connected.set()
+
+    def on_message(self, client, userdata, message):
+        if message.topic == f'{self.ha_status}/status':
+            if message.payload.decode() == 'online':
+                for device in self.devices.values():
+                    device.birth()
+            return
+        # Retained discovery messages, see system_sensors.on_message
+        parts = message.topic.split('/')
+        device = self.devices.get(parts[2]) if len(parts) > 2 else None
+        if device is not None:
+            device.state['retained_config'][message.topic] = message.payload
+
+    def on_publish(self, client, userdata, mid, *args):
+        now = time.monotonic()
+        with self.lock:
+            if mid not in self.unacked:
+                self.early[mid] = now
+                return
+            sent, kind, phase = self.unacked.pop(mid)
+        self.stats.acked(sent, kind, phase, now)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = b'' if payload is None else payload.encode('utf-8') if isinstance(payload, str) else payload
+        kind = message_kind(topic)
+        phase = self.stats.sent(kind, len(topic.encode('utf-8')) + len(payload))
+        sent = time.monotonic()
+        if self.sent_times is not None:
+            self.sent_times[topic].append((sent, kind, phase))
+        # Not under the lock, paho calls on_publish with its own lock held
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if qos:
+            with self.lock:
+                acked = self.early.pop(info.mid, None)
+                if acked is None:
+                    self.unacked[info.mid] = (sent, kind, phase)
+            if acked is not None:
+                self.stats.acked(sent, kind, phase, acked)
+        return info
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+class Observer:
+    """Stands in for Home Assistant, receiving every device message and sending the birth message."""
+    def __init__(self, args, stats, ha_status):
+        self.stats = stats
+        self.ha_status = ha_status
+        self.sent_times = collections.defaultdict(collections.deque)
+        self.subscribed = threading.Event()
+        self.client = new_client(f'{args.prefix}-observer')
+        self.client.on_connect = self.on_connect
+        self.client.on_subscribe = lambda *args: self.subscribed.set()
+        self.client.on_message = self.on_message
+        if args.user:
+            self.client.username_pw_set(args.user, args.password)
+
+    def connect(self, host, port):
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, reason_code=0, properties=None):
+        client.subscribe([('system-sensors/#', 1), ('homeassistant/#', 1)])
+
+    def on_message(self, client, userdata, message):
+        now = time.monotonic()
+        # Retained messages of earlier runs were not timed, the broker keeps per topic order
+        times = self.sent_times.get(message.topic)
+        if times:
+            sent, kind, phase = times.popleft()
+            self.stats.delivered(sent, kind, phase, now)
+
+    def birth(self):
+        self.client.publish(f'{self.ha_status}/status', 'online')
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+class DeviceClient:
+    """What one device's code sees as mqttClient, publishing over the shared connection."""
+    def __init__(self, device):
+        self.device = device
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if retain:
+            self.device.retained.add(topic)
+        return self.device.connection.publish(topic, payload, qos, retain)
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+class DiscoveryCapture:
+    """Collects what send_config_message would publish, so it can be paced at the device's discovery_rate."""
+    def __init__(self, device):
+        self.device = device
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.device.discovery.append((topic, payload, qos, retain))
+
+class Device:
+    def __init__(self, ss, index, connection, args):
+        self.name = f'{args.prefix}{index:04d}'
+        self.connection = connection
+        self.rng = random.Random(f'{args.seed}-{index}')
+        self.values = {}
+        self.retained = set()
+        self.state = {
+            'devicename': self.name,
+            'deviceNameDisplay': self.name,
+            'mqttClient': DeviceClient(self),
+            'sensor_values': {},
+            'stale_sensors': set(),
+            'in_flight': {},
+            'published_values': {},
+            'published_stale': [],
+            'last_publish': 0,
+            'config_messages': {},
+            'config_key': None,
+            'retained_config': {},
+            # Its own sample windows, the statistics sensors read them through synthesize
+            'samplers': {sensor: ss.SampleWindow(len(window.samples)) for sensor, window in ss.samplers.items()},
+        }
+        # Same per sensor schedule as the real script, with the devices spread over their intervals.
+        # One offset per device, so its sensors come due together like on a real host
+        offset = self.rng.uniform(0, ss.settings['update_interval'])
+        self.job = ss.Scheduler(execute=None)
+        for sensor in ss.periodic_sensors():
+            self.job.add(sensor, offset)
+            self.job.intervals[sensor] = ss.get_sensor_interval(sensor)
+        self.sample_job = ss.Scheduler(execute=None)
+        for sensor in ss.samplers:
+            self.sample_job.add(sensor, offset)
+            self.sample_job.intervals[sensor] = ss.get_sensor_option(sensor, 'sample_interval', None)
+        self.jitter = ss.settings['rediscovery_jitter']
+        self.rediscover_at = None
+        self.discovery = collections.deque()
+        self.rate = ss.settings['discovery_rate']
+        self.burst = max(1, self.rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        connection.devices[self.name] = self
+
+    def activate(self, ss):
+        vars(ss).update(self.state)
+
+    def deactivate(self, ss):
+        self.state = {name: getattr(ss, name) for name in DEVICE_STATE}
+
+    def subscribe(self):
+        client = self.connection.client
+        client.subscribe(f'homeassistant/+/{self.name}/+/config')
+        client.subscribe(f'homeassistant/device/{self.name}/config')
+
+    def birth(self):
+        # Like schedule_rediscovery, births arriving meanwhile are coalesced
+        if self.rediscover_at is None:
+            self.rediscover_at = time.monotonic() + self.rng.uniform(0, self.jitter)
+
+    def next_event(self):
+        times = [job.queue[0][0] for job in (self.job, self.sample_job) if job.queue]
+        if self.rediscover_at is not None:
+            times.append(self.rediscover_at)
+        if self.discovery:
+            times.append(self.updated + max(0, 1 - self.tokens) / self.rate if self.rate > 0 else 0)
+        return min(times) if times else None
+
+    def send_discovery(self, now):
+        # The TokenBucket of system_sensors, without sleeping
+        while self.discovery:
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    return
+                self.tokens -= 1
+            self.state['mqttClient'].publish(*self.discovery.popleft())
+
+    def synthetic(self, sensor, attr):
+        """Next value of a sensor, numbers take a random walk within a plausible range."""
+        if attr.get('sensor_type') == 'binary_sensor':
+            return self.rng.random() < 0.05
+        if attr.get('class') == 'timestamp':
+            if attr.get('category') == 'static':
+                return self.values.setdefault(sensor, dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat())
+            return dt.datetime.now(dt.timezone.utc).replace(microsecond=0).isoformat()
+        if 'state_class' not in attr and 'unit' not in attr:
+            return f'{self.name} {sensor}'
+        high = 100 if attr.get('unit') == '%' else 90 if attr.get('class') == 'temperature' else 1000
+        value = self.values.get(sensor, self.rng.uniform(0, high))
+        value = min(high, max(0, value + self.rng.gauss(0, high / 50)))
+        self.values[sensor] = value
+        return round(value, 1)
+
+def load_settings(args):
+    settings = {}
+    if args.settings:
+        with open(args.settings) as f:
+            settings = yaml.safe_load(f) or {}
+    mqtt_settings = settings.setdefault('mqtt', {})
+    args.host = args.host or mqtt_settings.get('hostname', 'localhost')
+    args.port = args.port or mqtt_settings.get('port', 1883)
+    args.user = args.user or mqtt_settings.get('user')
+    args.password = args.password or mqtt_settings.get('password')
+    mqtt_settings['hostname'] = args.host
+    settings.update({'devicename': args.prefix, 'client_id': args.prefix, 'workers': 0, 'runtime': 'threads',
+                     'self_metrics': False, 'spool': {'enabled': False}, 'prometheus': {'enabled': False},
+                     'guests': {'enabled': False}})
+    settings.setdefault('timezone', 'UTC')
+    settings.setdefault('sensors', {})
+    if args.update_interval:
+        settings['update_interval'] = args.update_interval
+    return settings
+
+def setup(ss, args):
+    ss.settings = ss.set_defaults(load_settings(args))
+    ss.check_settings(ss.settings)
+    # The drives don't exist here, their values are synthetic like all others
+    for drive, drive_path in (ss.settings['sensors'].get('external_drives') or {}).items():
+        ss.sensors[f'disk_use_{drive.lower()}'] = ss.external_drive_base(drive, drive_path)
+        ss.external_drives.append(f'disk_use_{drive.lower()}')
+    ss.add_interfaces_and_disks()
+    ss.add_sampled_sensors()
+    ss.deviceManufacturer = 'system_sensors'
+    ss.deviceModel = 'Fleet Simulator'
+    ss.ha_status = ss.settings['ha_status']
+    # Discovery is paced per device by Device.send_discovery instead
+    ss.discovery_limiter = None
+    ss.outbound = None
+    ss.connected.set()
+
+def synthesize(ss, current):
+    statistics = {}
+    for sensor in ss.samplers:
+        for statistic in ss.get_sensor_option(sensor, 'statistics', ['min', 'max', 'mean', 'p95']):
+            statistics[f'{sensor}_{statistic}'] = (sensor, statistic)
+    for sensor, attr in ss.sensors.items():
+        attr.pop('command', None)
+        if sensor in statistics:
+            # Aggregates the running device's own window instead of the one add_sampled_sensors bound
+            attr['function'] = lambda *args, sampled=statistics[sensor]: \
+                current[0].state['samplers'][sampled[0]].aggregate(sampled[1])
+        else:
+            attr['function'] = lambda *args, sensor=sensor, attr=attr: current[0].synthetic(sensor, attr)
+
+def run_device(ss, device, current, now):
+    if device.discovery:
+        device.send_discovery(now)
+    due_samples = device.sample_job.queue and device.sample_job.queue[0][0] <= now
+    due_sensors = device.job.queue and device.job.queue[0][0] <= now
+    due_discovery = device.rediscover_at is not None and device.rediscover_at <= now
+    if not due_samples and not due_sensors and not due_discovery:
+        return
+    current[0] = device
+    device.activate(ss)
+    try:
+        if due_samples:
+            ss.sample_sensors(device.sample_job.pop_due())
+        if due_sensors:
+            ss.update_sensors(device.job.pop_due())
+        if due_discovery:
+            device.rediscover_at = None
+            ss.send_config_message(DiscoveryCapture(device))
+            device.send_discovery(now)
+    finally:
+        device.deactivate(ss)
+
+def start_device(ss, device, current):
+    # What on_connect does: availability, the static sensors, and discovery after the jitter
+    current[0] = device
+    device.activate(ss)
+    try:
+        ss.mqttClient.publish(f'system-sensors/sensor/{device.name}/availability', 'online', retain=True)
+        ss.refresh_static_sensors(force=True)
+    finally:
+        device.deactivate(ss)
+    device.birth()
+
+def clean_up(devices):
+    for device in devices:
+        for topic in sorted(device.retained):
+            device.connection.client.publish(topic, '', qos=1, retain=True)
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Simulate a fleet of system_sensors hosts against an MQTT broker')
+    parser.add_argument('--devices', type=int, default=100, help='virtual devices to run')
+    parser.add_argument('--connections', type=int, default=10, help='broker connections shared by the devices')
+    parser.add_argument('--duration', type=float, default=120, help='seconds to run')
+    parser.add_argument('--birth-at', type=float, default=60, help='seconds after the start to send the HA birth message, negative for never')
+    parser.add_argument('--force-discovery', action='store_true',
+                        help='resend every discovery message on the birth, as after a settings change, instead of skipping the retained ones')
+    parser.add_argument('--settings', help='settings.yaml to simulate, its mqtt section is the default broker')
+    parser.add_argument('--update-interval', type=float, help='overrides update_interval of the settings')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--prefix', default='fleetsim', help='devicename prefix, the devices are <prefix>0000, <prefix>0001, ...')
+    parser.add_argument('--seed', default='fleet', help='seed of the synthetic values')
+    parser.add_argument('--keep', action='store_true', help='leave the retained messages of the devices on the broker')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    return parser
+
+if __name__ == '__main__':
+    args = _parser().parse_args()
+    # Sensor and discovery output goes to stderr so stdout only holds the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        import system_sensors as ss
+        setup(ss, args)
+        current = [None]
+        synthesize(ss, current)
+        stats = Stats()
+        observer = Observer(args, stats, ss.ha_status)
+        observer.connect(args.host, args.port)
+        if not observer.subscribed.wait(10):
+            raise SystemExit(f'Could not subscribe at {args.host}:{args.port}')
+        # Give the broker time to deliver the retained messages of earlier runs first
+        time.sleep(1)
+        connections = []
+        for index in range(args.connections):
+            # A connection of its own is named after its device, shared ones after their index
+            client_id = f'{args.prefix}{index:04d}' if args.connections >= args.devices else f'{args.prefix}-{index:03d}'
+            connection = Connection(client_id, args, stats, ss.ha_status)
+            connection.sent_times = observer.sent_times
+            connections.append(connection)
+        devices = [Device(ss, index, connections[index % args.connections], args) for index in range(args.devices)]
+        for connection in connections:
+            connection.connect(args.host, args.port)
+        for connection in connections:
+            if not connection.connected.wait(10):
+                raise SystemExit(f'A connection to {args.host}:{args.port} was not accepted')
+        # Let the retained discovery messages of the devices arrive, like the rediscovery delay does
+        time.sleep(1)
+        start = time.monotonic()
+        stats.start_phase('startup')
+        cpu_start = time.process_time()
+        for device in devices:
+            start_device(ss, device, current)
+        birth_at = start + args.birth_at if args.birth_at >= 0 else None
+        end = start + args.duration
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            if birth_at is not None and now >= birth_at:
+                birth_at = None
+                if args.force_discovery:
+                    for device in devices:
+                        device.state['retained_config'].clear()
+                stats.start_phase('birth')
+                observer.birth()
+            for device in devices:
+                run_device(ss, device, current, now)
+            wake = min([at for at in (device.next_event() for device in devices) if at is not None] +
+                       [end] + ([birth_at] if birth_at is not None else []))
+            time.sleep(min(0.05, max(0, wake - time.monotonic())))
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+        # Late acknowledgements and deliveries still count, later messages don't
+        time.sleep(2)
+        results = {
+            'args': {key: value for key, value in vars(args).items() if key != 'password'},
+            'sensors_per_device': len(ss.enabled_sensors()),
+            'sampled_sensors_per_device': len(ss.samplers),
+            'devices_per_connection': round(args.devices / args.connections, 2),
+            'discovery_messages_per_device': len(devices[0].state['config_messages']) if devices else 0,
+            'results': stats.report(elapsed),
+            'simulator_cpu_s': round(cpu, 3),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if not args.keep:
+            clean_up(devices)
+            time.sleep(1)
+        observer.close()
+        for connection in connections:
+            connection.close()
+    finally:
+        sys.stdout = stdout
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -30,8 +30,12 @@ mkdir -p  /home/systemsensors/etc/ /home/systemsensors/bin/
 
 curl -o /home/systemsensors/bin/sensors.py https://raw.githubusercontent.com/Sennevds/system_sensors/master/src/sensors.py
 curl -o /home/systemsensors/bin/system_sensors.py  https://raw.githubusercontent.com/Sennevds/system_sensors/master/src/system_sensors.py
+curl -o /home/systemsensors/bin/guests.py https://raw.githubusercontent.com/Sennevds/system_sensors/master/src/guests.py
+curl -o /home/systemsensors/bin/spool.py https://raw.githubusercontent.com/Sennevds/system_sensors/master/src/spool.py
+curl -o /home/systemsensors/bin/metrics.py https://raw.githubusercontent.com/Sennevds/system_sensors/master/src/metrics.py
 
-chmod 755 /home/systemsensors/bin/sensors.py /home/systemsensors/bin/system_sensors.py
+chmod 755 /home/systemsensors/bin/sensors.py /home/systemsensors/bin/system_sensors.py /home/systemsensors/bin/guests.py \
+          /home/systemsensors/bin/spool.py /home/systemsensors/bin/metrics.py
 chown -R systemsensors:systemsensors /home/systemsensors/
 
 
@@ -44,6 +48,8 @@ deviceName: $DEVICENAME
 client_id: $DEVICENAME
 timezone: $TIMEZONE
 update_interval: 60 #Defaults to 60
+guests:
+  enabled: false # true to publish every running LXC container and VM as its own device
 sensors:
   temperature: true
   clock_speed: true
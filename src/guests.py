@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Per guest metrics of a Proxmox host, read from the cgroup v2 accounting files
+# of every running LXC container and QEMU VM in one pass.
+
+import os
+import re
+import collections
+
+from sensors import Snapshot, CounterRates, read_file, close_files, get_cpu_count
+
+GuestCounters = collections.namedtuple('GuestCounters', ['kind', 'cpu_usec', 'memory', 'memory_max', 'read_bytes', 'write_bytes'])
+
+guest_kinds = {
+    'lxc': 'LXC Container',
+    'qemu': 'QEMU VM',
+}
+
+def find_guests(cgroup_root):
+    """Return {guest id: (kind, cgroup directory)} for every running guest."""
+    guests = {}
+    lxc_root = os.path.join(cgroup_root, 'lxc')
+    if os.path.isdir(lxc_root):
+        for entry in os.listdir(lxc_root):
+            if entry.isdigit():
+                guests[entry] = ('lxc', os.path.join(lxc_root, entry))
+    qemu_root = os.path.join(cgroup_root, 'qemu.slice')
+    if os.path.isdir(qemu_root):
+        for entry in os.listdir(qemu_root):
+            match = re.match(r'^(\d+)\.scope$', entry)
+            if match:
+                guests[match.group(1)] = ('qemu', os.path.join(qemu_root, entry))
+    return guests
+
+def read_keyed(path):
+    values = {}
+    for line in read_file(path).splitlines():
+        key, _, value = line.partition(' ')
+        values[key] = value
+    return values
+
+def read_io(path):
+    read_bytes = 0
+    write_bytes = 0
+    # One line per device: "8:0 rbytes=1 wbytes=2 rios=3 ..."
+    for line in read_file(path).splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition('=')
+            if key == 'rbytes':
+                read_bytes += int(value)
+            elif key == 'wbytes':
+                write_bytes += int(value)
+    return read_bytes, write_bytes
+
+def read_guest(kind, cgroup):
+    cpu_usec = int(read_keyed(os.path.join(cgroup, 'cpu.stat'))['usage_usec'])
+    memory = int(read_file(os.path.join(cgroup, 'memory.current')))
+    memory_max = read_file(os.path.join(cgroup, 'memory.max')).strip()
+    read_bytes, write_bytes = read_io(os.path.join(cgroup, 'io.stat'))
+    return GuestCounters(kind, cpu_usec, memory, None if memory_max == 'max' else int(memory_max), read_bytes, write_bytes)
+
+# cgroup directories whose accounting files were opened in the last pass
+guest_cgroups = set()
+
+def read_guests(cgroup_root):
+    """Return {guest id: GuestCounters} for all running guests."""
+    global guest_cgroups
+    guests = find_guests(cgroup_root)
+    cgroups = {cgroup for kind, cgroup in guests.values()}
+    # Guests that stopped since the last pass keep no files open
+    for cgroup in guest_cgroups - cgroups:
+        close_files(cgroup + '/')
+    guest_cgroups = cgroups
+    counters = {}
+    for guest, (kind, cgroup) in guests.items():
+        try:
+            counters[guest] = read_guest(kind, cgroup)
+        except (OSError, KeyError, ValueError):
+            # The guest stopped while we were reading it
+            close_files(cgroup + '/')
+    return counters
+
+def get_guest_name(pve_root, guest, kind):
+    config = os.path.join(pve_root, 'lxc' if kind == 'lxc' else 'qemu-server', f'{guest}.conf')
+    key = 'hostname' if kind == 'lxc' else 'name'
+    try:
+        with open(config) as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        # /etc/pve is only readable by root and www-data
+        pass
+    return f'{guest_kinds[kind]} {guest}'
+
+guest_rates = CounterRates('guests', ('cpu_usec', 'read_bytes', 'write_bytes'))
+
+def get_guest_cpu(guest, current):
+    return round(guest_rates.get(guest, 'cpu_usec', current) / 1000000 / get_cpu_count() * 100, 1)
+
+def get_guest_memory(guest, current):
+    return round(current.get('guests')[guest].memory / 1048576, 1)
+
+def get_guest_memory_use(guest, current):
+    counters = current.get('guests')[guest]
+    return round(counters.memory / counters.memory_max * 100, 1) if counters.memory_max else None
+
+def get_guest_disk_read(guest, current):
+    return round(guest_rates.get(guest, 'read_bytes', current) / 1024, 1)
+
+def get_guest_disk_write(guest, current):
+    return round(guest_rates.get(guest, 'write_bytes', current) / 1024, 1)
+
+guest_sensors = {
+          'cpu_usage':
+                {'name': 'CPU Usage',
+                 'state_class': 'measurement',
+                 'unit': '%',
+                 'icon': 'chip',
+                 'sensor_type': 'sensor',
+                 'function': get_guest_cpu},
+          'memory':
+                {'name': 'Memory',
+                 'class': 'data_size',
+                 'state_class': 'measurement',
+                 'unit': 'MiB',
+                 'icon': 'memory',
+                 'sensor_type': 'sensor',
+                 'function': get_guest_memory},
+          'memory_use':
+                {'name': 'Memory Use',
+                 'state_class': 'measurement',
+                 'unit': '%',
+                 'icon': 'memory',
+                 'sensor_type': 'sensor',
+                 'function': get_guest_memory_use},
+          'disk_read':
+                {'name': 'Disk Read',
+                 'class': 'data_rate',
+                 'state_class': 'measurement',
+                 'unit': 'kB/s',
+                 'icon': 'harddisk',
+                 'sensor_type': 'sensor',
+                 'function': get_guest_disk_read},
+          'disk_write':
+                {'name': 'Disk Write',
+                 'class': 'data_rate',
+                 'state_class': 'measurement',
+                 'unit': 'kB/s',
+                 'icon': 'harddisk',
+                 'sensor_type': 'sensor',
+                 'function': get_guest_disk_write},
+          }
+
+def collect_guests(cgroup_root):
+    """Read all running guests in one batched pass, return {guest id: (kind, {sensor: value})}."""
+    current = Snapshot({'guests': lambda: read_guests(cgroup_root)})
+    guest_rates.prune(current.get('guests'))
+    guests = {}
+    for guest, counters in current.get('guests').items():
+        values = {}
+        for sensor, attr in guest_sensors.items():
+            value = attr['function'](guest, current)
+            # Memory use is only known for guests with a memory limit
+            if value is not None:
+                values[sensor] = value
+        guests[guest] = (counters.kind, values)
+    return guests
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Prometheus / OpenMetrics endpoint for the collected sensor values.
+#
+# Scrapes are answered from the last collection. Only when that is older than
+# max_age a new collection runs, scrapes arriving in the meantime wait for it
+# instead of starting their own. The rendered text is kept until the next
+# collection, so frequent scrapes cost next to nothing.
+
+import re
+import math
+import time
+import threading
+import http.server
+
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+
+def metric_name(name):
+    return 'system_sensors_' + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+def render(gauges, infos, openmetrics=True):
+    """Render gauges [(name, help, [(labels, value)])] and infos [(name, help, labels)] in the exposition format."""
+    lines = []
+    for name, description, samples in gauges:
+        name = metric_name(name)
+        lines.append(f'# HELP {name} {escape(description)}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+    for name, description, labels in infos:
+        name = metric_name(name)
+        # OpenMetrics has an info type, the Prometheus text format uses a gauge named *_info
+        family = name if openmetrics else f'{name}_info'
+        lines.append(f'# HELP {family} {escape(description)}')
+        lines.append(f'# TYPE {family} {"info" if openmetrics else "gauge"}')
+        lines.append(f'{name}_info{format_labels(labels)} 1')
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        try:
+            body = self.server.scrape(openmetrics).encode('utf-8')
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS if openmetrics else TEXT)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serve /metrics, collecting through refresh when the last collection is older than max_age.
+
+    collected returns the monotonic time of the last collection and families
+    returns the (gauges, infos) to render from it.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, port, refresh, collected, families, max_age):
+        http.server.ThreadingHTTPServer.__init__(self, (address, port), MetricsHandler)
+        self.refresh = refresh
+        self.collected = collected
+        self.families = families
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.cache_time = None
+
+    def scrape(self, openmetrics):
+        with self.lock:
+            if time.monotonic() - self.collected() > self.max_age:
+                self.refresh()
+            if self.collected() != self.cache_time:
+                self.cache = {}
+                self.cache_time = self.collected()
+            if openmetrics not in self.cache:
+                self.cache[openmetrics] = render(*self.families(), openmetrics=openmetrics)
+            return self.cache[openmetrics]
@@ -2,7 +2,6 @@
 
 import re
 import time
-import pytz
 import psutil
 import socket
 import platform
@@ -12,6 +11,14 @@ import sys
 import os
 import shutil
 import json
+import fcntl
+import select
+import array
+import math
+import struct
+import threading
+import importlib.util
+import collections
 # import os.path
 
 class PropertyBag(dict):
@@ -20,30 +27,267 @@ class PropertyBag(dict):
             self[key] = str.replace(self[key], "{device_name}", device_name)
         return str.replace(str.replace(json.dumps(self), "{", ''), "}", '')
 
-# Only needed if using alternate method of obtaining CPU temperature (see commented out code for approach)
-#from os import walk
+class FileReader:
+    """Keep a small kernel or host file open and re-read it from offset 0 on every call."""
+    def __init__(self, path:str):
+        self.path = path
+        self.fd = None
 
+    def read(self) -> str:
+        for attempt in range(2):
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                chunks = []
+                chunk = os.read(self.fd, 4096)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = os.read(self.fd, 4096)
+                return b''.join(chunks).decode('utf-8')
+            except OSError:
+                # The file may have been replaced, reopen it once before giving up
+                self.close()
+                if attempt:
+                    raise
 
-rpi_power_disabled = True
-try:
-    from rpi_bad_power import new_under_voltage
-    if new_under_voltage() is not None:
-        # Only enable if import works and function returns a value
-        rpi_power_disabled = False
-except ImportError:
-    pass
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
-try:
-    import apt
-    apt_disabled = False
-except ImportError:
-    apt_disabled = True
+file_readers = {}
+
+def read_file(path):
+    if path not in file_readers:
+        file_readers[path] = FileReader(path)
+    return file_readers[path].read()
+
+def close_files(prefix):
+    for path in [path for path in file_readers if path.startswith(prefix)]:
+        file_readers.pop(path).close()
+
+def read_meminfo():
+    """Return the /proc/meminfo fields in kB."""
+    meminfo = {}
+    for line in read_file('/proc/meminfo').splitlines():
+        key, _, value = line.partition(':')
+        meminfo[key] = int(value.split()[0])
+    return meminfo
+
+DiskCounters = collections.namedtuple('DiskCounters', ['read_bytes', 'write_bytes'])
+
+def read_diskstats():
+    """Return {disk: DiskCounters} parsed from /proc/diskstats, sectors are always 512 bytes there."""
+    disks = {}
+    for line in read_file('/proc/diskstats').splitlines():
+        fields = line.split()
+        if len(fields) >= 10:
+            disks[fields[2]] = DiskCounters(int(fields[5]) * 512, int(fields[9]) * 512)
+    return disks
+
+# Kernel sources shared by several sensors, each is read at most once per collection cycle
+snapshot_sources = {
+    'loadavg': lambda: psutil.getloadavg(),
+    'meminfo': read_meminfo,
+    'net_io': lambda: psutil.net_io_counters(pernic=True),
+    'diskstats': read_diskstats,
+    'zpools': lambda: read_zpools(),
+    'disk_usage': lambda: read_disk_usage(),
+}
+
+class Snapshot:
+    """Lazily read each kernel source the first time a sensor needs it during a cycle."""
+    def __init__(self, sources=None):
+        self.sources = snapshot_sources if sources is None else sources
+        self.values = {}
+        self.times = {}
+        # One lock per source, a slow source like zpools only holds up its own readers
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        with self.lock:
+            lock = self.locks.setdefault(source, threading.Lock())
+        with lock:
+            if source not in self.values:
+                self.values[source] = self.sources[source]()
+                self.times[source] = time.monotonic()
+            return self.values[source]
+
+snapshot = Snapshot()
+
+# Collectors running next to the cycle, like the sampler, read from their own snapshot on their thread
+local_snapshot = threading.local()
+
+def get_snapshot():
+    return getattr(local_snapshot, 'snapshot', None) or snapshot
+
+def new_snapshot():
+    """Start a new collection cycle, sources are read again on first use."""
+    global snapshot
+    snapshot = Snapshot()
+
+class CounterRates:
+    """Per-second rates of the counters in a snapshot source, for every requested name at once.
+
+    The previous samples live in flat arrays indexed by name and field, all rates
+    are computed in a single pass the first time a rate is asked for in a cycle.
+    Name None is the total over all names in the source.
+    """
+    def __init__(self, source, fields):
+        self.source = source
+        self.fields = fields
+        self.index = {}
+        self.previous = array.array('Q')
+        self.seen = bytearray()
+        self.rates = array.array('d')
+        self.snapshot = None
+        self.sample_time = 0
+        self.lock = threading.Lock()
+
+    def sample(self, counters, name):
+        if name is None:
+            return [sum(getattr(values, field) for values in counters.values()) for field in self.fields]
+        if name not in counters:
+            return None
+        return [getattr(counters[name], field) for field in self.fields]
+
+    def add(self, name):
+        self.index[name] = len(self.index)
+        self.previous.extend([0] * len(self.fields))
+        self.seen.append(0)
+        self.rates.extend([0.0] * len(self.fields))
+        if self.snapshot is not None:
+            # Seed from the sample the other names were last computed from
+            values = self.sample(self.snapshot.get(self.source), name)
+            if values is not None:
+                self.previous[self.index[name] * len(self.fields):(self.index[name] + 1) * len(self.fields)] = array.array('Q', values)
+                self.seen[self.index[name]] = 1
+
+    def update(self, current):
+        counters = current.get(self.source)
+        now = current.times[self.source]
+        elapsed = now - self.sample_time
+        width = len(self.fields)
+        for name, index in self.index.items():
+            values = self.sample(counters, name)
+            if values is None:
+                # Interface or disk is gone, start over when it comes back
+                self.seen[index] = 0
+                self.rates[index * width:(index + 1) * width] = array.array('d', [0.0] * width)
+                continue
+            for field in range(width):
+                position = index * width + field
+                delta = values[field] - self.previous[position]
+                if delta < 0:
+                    # A 32 bit counter that wrapped, otherwise the counter was reset and this sample only reseeds it
+                    delta = values[field] + 2 ** 32 - self.previous[position] if self.previous[position] < 2 ** 32 <= self.previous[position] + 2 ** 31 else 0
+                self.rates[position] = delta / elapsed if self.seen[index] and elapsed > 0 else 0.0
+                self.previous[position] = values[field]
+            self.seen[index] = 1
+        self.snapshot = current
+        self.sample_time = now
+
+    def prune(self, names):
+        """Forget the samples of every name not in names, like guests that stopped."""
+        with self.lock:
+            kept = [name for name in self.index if name is None or name in names]
+            if len(kept) == len(self.index):
+                return
+            width = len(self.fields)
+            previous, seen, rates = array.array('Q'), bytearray(), array.array('d')
+            for name in kept:
+                index = self.index[name]
+                previous.extend(self.previous[index * width:(index + 1) * width])
+                seen.append(self.seen[index])
+                rates.extend(self.rates[index * width:(index + 1) * width])
+            self.index = {name: index for index, name in enumerate(kept)}
+            self.previous, self.seen, self.rates = previous, seen, rates
+
+    def get(self, name, field, current=None):
+        # Sensors use the cycle snapshot, other collectors can pass their own
+        current = get_snapshot() if current is None else current
+        with self.lock:
+            if name not in self.index:
+                self.add(name)
+            if self.snapshot is not current:
+                self.update(current)
+            return self.rates[self.index[name] * len(self.fields) + self.fields.index(field)]
+
+net_rates = CounterRates('net_io', ('bytes_sent', 'bytes_recv'))
+disk_rates = CounterRates('diskstats', ('read_bytes', 'write_bytes'))
+# The sampler's own engines, its snapshots would otherwise interleave with the cycle's previous counters
+sampler_rates = {rates.source: CounterRates(rates.source, rates.fields) for rates in [net_rates, disk_rates]}
+
+def get_rates(rates):
+    return getattr(local_snapshot, 'rates', {}).get(rates.source, rates)
+
+class SampleWindow:
+    """The most recent samples of one sensor in a fixed size ring."""
+    def __init__(self, size):
+        self.samples = array.array('d', [0.0] * size)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = value
+            self.count += 1
+
+    def values(self):
+        with self.lock:
+            return self.samples[:min(self.count, len(self.samples))]
+
+    def aggregate(self, statistic):
+        values = self.values()
+        if not values:
+            return None
+        if statistic == 'min':
+            return min(values)
+        if statistic == 'max':
+            return max(values)
+        if statistic == 'mean':
+            return round(sum(values) / len(values), 2)
+        # Percentiles like p95, nearest rank
+        values = sorted(values)
+        return values[max(0, math.ceil(int(statistic[1:]) / 100 * len(values)) - 1)]
+
+def is_statistic(statistic):
+    return statistic in ['min', 'max', 'mean'] or re.fullmatch('p([1-9][0-9]?|100)', str(statistic)) is not None
+
+cpu_count = None
+
+def get_cpu_count():
+    global cpu_count
+    if cpu_count is None:
+        cpu_count = psutil.cpu_count()
+    return cpu_count
+
+# Paths of the drives whose usage is read in one statvfs pass per cycle
+disk_usage_paths = ['/']
+zpool_binary = None
+Mount = collections.namedtuple('Mount', ['device', 'fstype'])
+
+# Chips the temperature and fan speed are read from when the settings don't name one, in order of preference
+TEMPERATURE_CHIPS = ['cpu-thermal', 'cpu_thermal', 'coretemp', 'soc_thermal', 'k10temp']
+FAN_CHIPS = ['pwmfan']
+HWMON_ROOT = '/sys/class/hwmon'
+THERMAL_ROOT = '/sys/class/thermal'
+HwmonInput = collections.namedtuple('HwmonInput', ['chip', 'label', 'path'])
+temperature_input = None
+fan_input = None
+hwmon_resolved = False
+
+# rpi_bad_power and apt are only imported once their sensor is read, and os-release once it is needed
+under_voltage = None
+os_data = None
 
 isDockerized = bool(os.getenv('YES_YOU_ARE_IN_A_CONTAINER', False))
 isOsRelease = os.path.isfile('/app/host/os-release')
 isHostname = os.path.isfile('/app/host/hostname')
 isDeviceTreeModel = os.path.isfile('/app/host/proc/device-tree/model')
-isSystemSensorPipe = os.path.isfile('/app/host/system_sensor_pipe')
+isHostRoutes = os.path.isfile('/app/host/proc/net/route')
 
 vcgencmd   = "vcgencmd"
 os_release = "/etc/os-release"
@@ -51,23 +295,43 @@ if isDockerized:
     os_release = "/app/host/os-release" if isOsRelease else '/etc/os-release'
     vcgencmd   = "/opt/vc/bin/vcgencmd"
 
-# Get OS information
-OS_DATA = {}
-with open(os_release) as f:
-    for line in f.readlines():
-        if not line in ['\n', '\r\n']:
-            row = line.strip().split("=")
-            OS_DATA[row[0]] = row[1].strip('"')
-
-old_net_data_tx = psutil.net_io_counters()[0]
-previous_time_tx = time.time() - 10
-old_net_data_rx = psutil.net_io_counters()[1]
-previous_time_rx = time.time() - 10
-UTC = pytz.utc
+UTC = dt.timezone.utc
 DEFAULT_TIME_ZONE = None
 
-if not rpi_power_disabled:
-    _underVoltage = new_under_voltage()
+# apt rewrites these whenever 'apt update' or dpkg runs, the updates count can only change then
+APT_STATE_PATHS = ['/var/lib/apt/lists', '/var/lib/dpkg/status']
+UPDATES_CHECK_INTERVAL = 60
+updates_max_age = 86400
+updates_count = None
+updates_watcher = None
+
+def get_os_data():
+    """Return the OS information from os-release, read on first use."""
+    global os_data
+    if os_data is None:
+        os_data = {}
+        with open(os_release) as f:
+            for line in f.readlines():
+                if not line in ['\n', '\r\n']:
+                    row = line.strip().split("=")
+                    os_data[row[0]] = row[1].strip('"')
+    return os_data
+
+def get_under_voltage():
+    """Return the rpi_bad_power probe, or None if the library is missing or doesn't support this host."""
+    global under_voltage
+    if under_voltage is None:
+        try:
+            from rpi_bad_power import new_under_voltage
+            # Only usable if the function returns a value
+            under_voltage = new_under_voltage() or False
+        except ImportError:
+            under_voltage = False
+    return under_voltage or None
+
+def apt_available():
+    # Finding the module doesn't import the python-apt stack
+    return importlib.util.find_spec('apt') is not None
 
 def set_default_timezone(timezone):
     global DEFAULT_TIME_ZONE
@@ -83,13 +347,13 @@ def as_local(dattim: dt.datetime) -> dt.datetime:
     if dattim.tzinfo == DEFAULT_TIME_ZONE:
         return dattim
     if dattim.tzinfo is None:
-        dattim = UTC.localize(dattim)
+        dattim = dattim.replace(tzinfo=UTC)
 
     return dattim.astimezone(DEFAULT_TIME_ZONE)
 
 def utc_from_timestamp(timestamp: float) -> dt.datetime:
     """Return a UTC time from a timestamp."""
-    return UTC.localize(dt.datetime.utcfromtimestamp(timestamp))
+    return dt.datetime.fromtimestamp(timestamp, UTC)
 
 def get_last_boot():
     return str(as_local(utc_from_timestamp(psutil.boot_time())).isoformat())
@@ -97,232 +361,454 @@ def get_last_boot():
 def get_last_message():
     return str(as_local(utc_from_timestamp(time.time())).isoformat())
 
-def get_updates():
+def set_updates_max_age(max_age):
+    global updates_max_age
+    updates_max_age = max_age
+
+def get_apt_state():
+    state = []
+    for state_path in APT_STATE_PATHS:
+        try:
+            state.append(os.stat(state_path).st_mtime_ns)
+        except OSError:
+            state.append(None)
+    return state
+
+def count_updates():
+    import apt
     cache = apt.Cache()
     cache.open(None)
     cache.upgrade()
-    return str(cache.get_changes().__len__())
+    count = len(cache.get_changes())
+    cache.close()
+    return count
+
+def watch_updates():
+    """Recount the pending updates when the apt state changes or the count gets older than updates_max_age."""
+    global updates_count
+    last_state = None
+    next_count = 0
+    failures = 0
+    while True:
+        state = get_apt_state()
+        if state != last_state or time.monotonic() >= next_count:
+            last_state = state
+            try:
+                updates_count = count_updates()
+                failures = 0
+                next_count = time.monotonic() + updates_max_age
+            except Exception as e:
+                # Retried once apt changes something, otherwise after a growing delay instead of at every check
+                failures += 1
+                next_count = time.monotonic() + min(updates_max_age, UPDATES_CHECK_INTERVAL * 2 ** failures)
+                print('Could not count available updates: ' + str(e))
+        time.sleep(UPDATES_CHECK_INTERVAL)
+
+def get_updates():
+    global updates_watcher
+    if updates_watcher is None:
+        updates_watcher = threading.Thread(target=watch_updates, name='updates', daemon=True)
+        updates_watcher.start()
+    return 'Unknown' if updates_count is None else updates_count
 
 # Temperature method depending on system distro
+def read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def find_hwmon_inputs(kind):
+    """List every temp or fan input of the hwmon chips, for temp also the thermal zones, in a stable order."""
+    inputs = []
+    try:
+        hwmons = sorted(os.listdir(HWMON_ROOT), key=lambda name: int(re.sub(r'\D', '', name) or 0))
+    except OSError:
+        hwmons = []
+    for hwmon in hwmons:
+        base = os.path.join(HWMON_ROOT, hwmon)
+        # Older drivers keep their files in the device directory
+        for directory in [base, os.path.join(base, 'device')]:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            chip = read_sysfs(os.path.join(directory, 'name')) or read_sysfs(os.path.join(base, 'name')) or hwmon
+            numbers = sorted(int(match.group(1)) for match in map(re.compile(f'^{kind}(\\d+)_input$').match, names) if match)
+            for number in numbers:
+                label = read_sysfs(os.path.join(directory, f'{kind}{number}_label')) or f'{kind}{number}'
+                inputs.append(HwmonInput(chip, label, os.path.join(directory, f'{kind}{number}_input')))
+    if kind == 'temp':
+        try:
+            zones = sorted((name for name in os.listdir(THERMAL_ROOT) if name.startswith('thermal_zone')),
+                           key=lambda name: int(re.sub(r'\D', '', name) or 0))
+        except OSError:
+            zones = []
+        for zone in zones:
+            chip = read_sysfs(os.path.join(THERMAL_ROOT, zone, 'type'))
+            if chip is not None:
+                inputs.append(HwmonInput(chip, zone, os.path.join(THERMAL_ROOT, zone, 'temp')))
+    return inputs
+
+def select_hwmon_input(inputs, chips, label=None):
+    for chip in chips:
+        for hwmon_input in inputs:
+            if hwmon_input.chip == chip and (label is None or hwmon_input.label == label):
+                return hwmon_input
+    return None
+
+def set_hwmon_inputs(temperature_chip=None, temperature_label=None, fan_chip=None, fan_label=None):
+    """Pick the temperature and fan inputs once, chips from settings or else the first known chip found."""
+    global temperature_input, fan_input, hwmon_resolved
+    temperature_input = select_hwmon_input(find_hwmon_inputs('temp'), [temperature_chip] if temperature_chip else TEMPERATURE_CHIPS, temperature_label)
+    fan_input = select_hwmon_input(find_hwmon_inputs('fan'), [fan_chip] if fan_chip else FAN_CHIPS, fan_label)
+    hwmon_resolved = True
+
+def read_hwmon_input(hwmon_input, kind):
+    value = int(read_file(hwmon_input.path))
+    # Temperatures are in millidegrees
+    return round(value / 1000, 1) if kind == 'temp' else value
+
 def get_temp():
     # Note that 'Unknown' can be problematic if no temp sensor is found, see get_fan_speed for the reason.
     # Alternatively, the default can be changed to -273 which is unlikely to happen...
-    temp = 'Unknown'
-    # Utilising psutil for temp reading on ARM arch
+    if not hwmon_resolved:
+        set_hwmon_inputs()
+    if temperature_input is None:
+        return 'Unknown'
     try:
-        t = psutil.sensors_temperatures()
-        for x in ['cpu-thermal', 'cpu_thermal', 'coretemp', 'soc_thermal', 'k10temp']:
-            if x in t:
-                temp = t[x][0].current
-                break
+        return read_hwmon_input(temperature_input, 'temp')
     except Exception as e:
-            print('Could not establish CPU temperature reading: ' + str(e))
-            raise
-    return round(temp, 1) if temp != 'Unknown' else temp
-
-            # Option to use thermal_zone readings instead of psutil
-
-            # base_dir = '/sys/class/thermal/'
-            # zone_dir = ''
-            # print('Could not cpu_thermal property. Checking thermal zone for x86 architecture')
-            # for root, dir, files in walk(base_dir):
-            #     for d in dir:
-            #         if 'thermal_zone' in d:
-            #             temp_type = str(subprocess.check_output(['cat', base_dir + d + '/type']).decode('UTF-8'))
-            #             if 'x86' in temp_type:
-            #                 zone_dir = d
-            #                 break
-            # temp = str(int(subprocess.check_output(['cat', base_dir + zone_dir + '/temp']).decode('UTF-8')) / 1000)
-
+        print('Could not establish CPU temperature reading: ' + str(e))
+        raise
 
 def get_fan_speed():
     # Formerly the default was 'Unknown' which generates in HA a string/number mismatch error if no fan is found
-    speed = -1
-    # Utilising psutil for fan speed reading on ARM arch
+    if not hwmon_resolved:
+        set_hwmon_inputs()
+    if fan_input is None:
+        return -1
     try:
-        if not hasattr(psutil, "sensors_fans"):
-            raise NotImplementedError("Platform does not support sensors_fans")
-
-        t = psutil.sensors_fans()
-        # if additional fan names returned by psutil are needed, add them here (see get_temp as example)
-        for x in ['pwmfan', ]:
-            if x in t:
-                speed = t[x][0].current
-                break
-    except (Exception, NotImplementedError) as e:
+        return read_hwmon_input(fan_input, 'fan')
+    except Exception as e:
         print('Could not establish fan speed reading: ' + str(e))
         raise
-    return round(speed, 0)
 
 
 # display power method depending on system distro
+def display_command():
+    if "rasp" in get_os_data()["ID"]:
+        return [vcgencmd, "display_power"]
+    return None
+
+def parse_display_status(reading):
+    return str(re.findall("^display_power=(?P<display_state>[01]{1})$", reading)[0])
+
 def get_display_status():
-    if "rasp" in OS_DATA["ID"]:
-        reading = subprocess.check_output([vcgencmd, "display_power"]).decode("UTF-8")
-        display_state = str(re.findall("^display_power=(?P<display_state>[01]{1})$", reading)[0])
-    else:
-        display_state = "Unknown"
-    return display_state
+    command = display_command()
+    if command is None:
+        return "Unknown"
+    return parse_display_status(subprocess.check_output(command).decode("UTF-8"))
 
 # Replaced with psutil method - does this not work fine?
 def get_clock_speed():
     clock_speed = int(psutil.cpu_freq().current)
     return clock_speed
 
+def statvfs_usage(path):
+    # Same as psutil.disk_usage().percent, the space reserved for root doesn't count as free
+    st = os.statvfs(path)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    total = used + st.f_bavail * st.f_frsize
+    return round(used / total * 100, 1) if total else 0.0
+
+def read_disk_usage():
+    """Usage of every registered drive path in one pass, None for paths that can't be read."""
+    usage = {}
+    for path in disk_usage_paths:
+        try:
+            usage[path] = statvfs_usage(path)
+        except OSError as e:
+            print('Error while trying to obtain disk usage from ' + str(path) + ' with exception: ' + str(e))
+            usage[path] = None
+    return usage
+
 def get_disk_usage(path):
+    usage = get_snapshot().get('disk_usage')
+    if path in usage:
+        return usage[path]
     try:
-        disk_percentage = str(psutil.disk_usage(path).percent)
-        return disk_percentage
+        return statvfs_usage(path)
     except Exception as e:
         print('Error while trying to obtain disk usage from ' + str(path) + ' with exception: ' + str(e))
         return None # Changed to return None for handling exception at function call location
 
-def get_zpool_use(pool):
-    zpool_locations = ['/usr/sbin/zpool', '/sbin/zpool']
-    zpool_binary = shutil.which("zpool") or next(filter(lambda l: os.path.isfile(l), zpool_locations), None)
+def get_zpool_binary():
+    global zpool_binary
+    if zpool_binary is None:
+        zpool_locations = ['/usr/sbin/zpool', '/sbin/zpool']
+        zpool_binary = shutil.which("zpool") or next(filter(lambda l: os.path.isfile(l), zpool_locations), None)
+    return zpool_binary
+
+def parse_zpool_list(output):
+    pools = {}
+    for line in output.splitlines():
+        name, _, capacity = line.partition('\t')
+        if capacity:
+            pools[name] = int(capacity)
+    return pools
+
+def read_zpools():
+    """Capacity of every pool from a single zpool list, the kstats under /proc/spl don't include it."""
     try:
-        zpool_percentage = str(subprocess.check_output(
-            [
-                zpool_binary,
-                'list',
-                '-H',
-                '-o',
-                'capacity',
-                '-p',
-                pool
-            ], timeout=2
-        ).decode('utf-8')).strip('\n')
-        return zpool_percentage
+        return parse_zpool_list(subprocess.check_output([get_zpool_binary(), 'list', '-H', '-p', '-o', 'name,capacity'],
+                                                        timeout=2).decode('utf-8'))
     except Exception as e:
-        print('Error while trying to obtain zpool usage from ' +
-              str(pool) + ' with exception: ' + str(e))
-        return None  # Changed to return None for handling exception at function call location
+        print('Error while trying to obtain zpool usage with exception: ' + str(e))
+        return {}
+
+def get_zpool_use(pool):
+    # None for handling a missing pool at function call location
+    return get_snapshot().get('zpools').get(pool)
+
+class MountTable:
+    """Mount points from /proc/self/mountinfo, parsed again only after the kernel flags a change."""
+    def __init__(self, path='/proc/self/mountinfo'):
+        self.path = path
+        self.fd = None
+        self.poller = None
+        self.mounts = {}
+        self.lock = threading.Lock()
+
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        chunk = os.read(self.fd, 65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = os.read(self.fd, 65536)
+        mounts = {}
+        for line in b''.join(chunks).decode('utf-8', 'replace').splitlines():
+            fields, _, filesystem = line.partition(' - ')
+            fields, filesystem = fields.split(), filesystem.split()
+            if len(fields) > 4 and len(filesystem) > 1:
+                # Spaces and other special characters in the mount point are octal escaped
+                mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[4])
+                mounts[mount_point] = Mount(filesystem[1], filesystem[0])
+        return mounts
+
+    def get(self):
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+                # The mount table raises POLLPRI whenever something is mounted or unmounted
+                self.poller = select.poll()
+                self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+                self.mounts = self.read()
+            elif self.poller.poll(0):
+                self.mounts = self.read()
+            return self.mounts
+
+mount_table = MountTable()
+
+def get_mounts():
+    return mount_table.get()
 
 def get_memory_usage():
-    return str(psutil.virtual_memory().percent)
+    meminfo = get_snapshot().get('meminfo')
+    if 'MemAvailable' not in meminfo:
+        return psutil.virtual_memory().percent
+    return round((meminfo['MemTotal'] - meminfo['MemAvailable']) / meminfo['MemTotal'] * 100, 1)
 
 def get_load(arg):
-    return round(psutil.getloadavg()[arg] / psutil.cpu_count() * 100, 1)
+    return round(get_snapshot().get('loadavg')[arg] / get_cpu_count() * 100, 1)
 
 def get_net_data_tx(interface = True):
-    global old_net_data_tx
-    global previous_time_tx
-    current_net_data = []
-    if type(interface) == str:
-        current_net_data = psutil.net_io_counters(pernic=True)[interface][0]
-    else:
-        current_net_data = psutil.net_io_counters()[0]
-    current_time = time.time()
-    if current_time == previous_time_tx:
-        current_time += 1
-    net_data = (current_net_data - old_net_data_tx) * 8 / (current_time - previous_time_tx) / 1024
-    previous_time_tx = current_time
-    old_net_data_tx = current_net_data
-    return f"{net_data:.2f}"
+    return round(get_rates(net_rates).get(interface if type(interface) == str else None, 'bytes_sent') * 8 / 1024, 2)
 
 def get_net_data_rx(interface = True):
-    global old_net_data_rx
-    global previous_time_rx
-    current_net_data = []
-    if type(interface) == str:
-        current_net_data = psutil.net_io_counters(pernic=True)[interface][1]
-    else:
-        current_net_data = psutil.net_io_counters()[1]
-    current_time = time.time()
-    if current_time == previous_time_rx:
-        current_time += 1
-    net_data = (current_net_data - old_net_data_rx) * 8 / (current_time - previous_time_rx) / 1024
-    previous_time_rx = current_time
-    old_net_data_rx = current_net_data
-    return f"{net_data:.2f}"
+    return round(get_rates(net_rates).get(interface if type(interface) == str else None, 'bytes_recv') * 8 / 1024, 2)
+
+def get_disk_read(disk):
+    return round(get_rates(disk_rates).get(disk, 'read_bytes') / 1024, 1)
+
+def get_disk_write(disk):
+    return round(get_rates(disk_rates).get(disk, 'write_bytes') / 1024, 1)
 
 def get_cpu_usage():
-    return str(psutil.cpu_percent(interval=None))
+    return psutil.cpu_percent(interval=None)
 
 def get_swap_usage():
-    return str(psutil.swap_memory().percent)
-
-def get_wifi_strength():  # subprocess.check_output(['/proc/net/wireless', 'grep wlan0'])
-    wifi_strength_value = subprocess.check_output(
-                              [
-                                  'bash',
-                                  '-c',
-                                  'cat /proc/net/wireless | grep wlan0: | awk \'{print int($4)}\'',
-                              ]
-                          ).decode('utf-8').rstrip()
-    if not wifi_strength_value:
-        wifi_strength_value = '0'
-    return (wifi_strength_value)
-
-def get_wifi_ssid():
+    meminfo = get_snapshot().get('meminfo')
+    if not meminfo.get('SwapTotal'):
+        return 0.0
+    return round((meminfo['SwapTotal'] - meminfo['SwapFree']) / meminfo['SwapTotal'] * 100, 1)
+
+# ioctl from linux/wireless.h, the same call iwgetid uses
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+
+def get_wireless_stats():
+    """Return {interface: signal level in dBm} parsed from /proc/net/wireless."""
+    stats = {}
     try:
-        ssid = subprocess.check_output(
-                                  [
-                                      'bash',
-                                      '-c',
-                                      '/usr/sbin/iwgetid -r',
-                                  ]
-                              ).decode('utf-8').rstrip()
-    except subprocess.CalledProcessError:
-        ssid = 'UNKNOWN'
-    if not ssid:
-        ssid = 'UNKNOWN'
-    return (ssid)
+        lines = read_file('/proc/net/wireless').splitlines()[2:]
+    except OSError:
+        return stats
+    for line in lines:
+        interface, _, values = line.partition(':')
+        values = values.split()
+        if len(values) >= 3:
+            stats[interface.strip()] = int(float(values[2]))
+    return stats
+
+def get_wifi_strength(interface = True):
+    stats = get_wireless_stats()
+    if type(interface) == str:
+        return stats.get(interface, 0)
+    if 'wlan0' in stats:
+        return stats['wlan0']
+    return next(iter(stats.values()), 0)
+
+def get_interface_ssid(interface):
+    essid = array.array('b', bytes(IW_ESSID_MAX_SIZE + 1))
+    request = struct.pack('16sPHH', interface.encode('utf-8'), essid.buffer_info()[0], IW_ESSID_MAX_SIZE + 1, 0)
+    # struct iwreq is 16 bytes of name followed by a 16 byte union
+    request += bytes(32 - len(request))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        fcntl.ioctl(sock.fileno(), SIOCGIWESSID, request)
+    return essid.tobytes().rstrip(b'\0').decode('utf-8', 'replace')
+
+def get_wifi_ssid(interface = True):
+    interfaces = [interface] if type(interface) == str else list(get_wireless_stats())
+    for name in interfaces:
+        try:
+            ssid = get_interface_ssid(name)
+        except OSError:
+            continue
+        if ssid:
+            return ssid
+    return 'UNKNOWN'
 
 def get_rpi_power_status():
-    return 'ON' if _underVoltage.get() else 'OFF'
+    return 'ON' if get_under_voltage().get() else 'OFF'
 
 def get_hostname():
     if isDockerized and isHostname:
-        host = subprocess.check_output(["cat", "/app/host/hostname"]).decode("UTF-8").strip()
+        host = read_file('/app/host/hostname').strip()
     else:
         host = socket.gethostname()
     return host
 
-def get_host_ip():
-    if isDockerized and isSystemSensorPipe:
-        return get_container_host_ip()
-    else:
+# rtnetlink multicast groups announcing IPv4 address and route changes
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTF_UP = 0x1
+Route = collections.namedtuple('Route', ['interface', 'destination', 'gateway', 'flags', 'metric', 'mask'])
+
+def parse_routes(data):
+    """Parse /proc/net/route, the addresses stay in the kernel's byte order as printed."""
+    routes = []
+    for line in data.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) > 7:
+            routes.append(Route(fields[0], int(fields[1], 16), int(fields[2], 16), int(fields[3], 16),
+                                int(fields[6]), int(fields[7], 16)))
+    return routes
+
+def parse_local_addresses(data):
+    """Addresses assigned to this host, the /32 host LOCAL leaves of /proc/net/fib_trie."""
+    addresses = set()
+    leaf = None
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith('|-- '):
+            leaf = line[4:]
+        elif leaf and line == '/32 host LOCAL':
+            addresses.add(struct.unpack('=I', socket.inet_aton(leaf))[0])
+    return addresses
+
+def select_host_address(routes, addresses):
+    """Address on the interface of the preferred default route, or on any interface when offline."""
+    routes = [route for route in routes if route.flags & RTF_UP and route.interface != 'lo']
+    defaults = sorted((route for route in routes if not route.mask), key=lambda route: route.metric)
+    for interface in [route.interface for route in defaults] + [route.interface for route in routes]:
+        for route in routes:
+            if route.interface != interface or not route.mask or route.gateway:
+                continue
+            for address in sorted(addresses):
+                if address & route.mask == route.destination:
+                    return socket.inet_ntoa(struct.pack('=I', address))
+    return None
+
+class HostAddress:
+    """Host address from the routing tables, resolved again only after they changed.
+
+    For our own network namespace the kernel announces changes over rtnetlink. The
+    host's tables mounted into a container are compared with the last read instead.
+    """
+    def __init__(self, proc='/proc/net', watch=True):
+        self.route_path = proc + '/route'
+        self.fib_trie_path = proc + '/fib_trie'
+        self.watch = watch
+        self.netlink = None
+        self.tables = None
+        self.address = None
+        self.lock = threading.Lock()
+
+    def subscribe(self):
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.connect(('8.8.8.8', 80))
-            return sock.getsockname()[0]
-        except socket.error:
+            self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK, socket.NETLINK_ROUTE)
+            self.netlink.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        except (OSError, AttributeError):
+            self.netlink = None
+
+    def changed(self):
+        """Drain the pending notifications, True when there were any."""
+        changed = False
+        while True:
             try:
-                return socket.gethostbyname(socket.gethostname())
-            except socket.gaierror:
-                return '127.0.0.1'
-        finally:
-            sock.close()
-
-def get_container_host_ip():
-     data = subprocess.check_output(["cat", "/app/host/system_sensor_pipe"]).decode("UTF-8")
-     ip = ""
-     for line in data.split('\n'):
-         mo = re.match ("^.{2}(?P<id>.{2}).{2}(?P<addr>.{8})..{4} .{8}..{4} (?P<status>.{2}).*|", line)
-         if mo and mo.group("id") != "sl":
-             status = int(mo.group("status"), 16)
-             if status == 1: # connection established
-                 ip = hex2addr(mo.group("addr"))
-                 break
-     return ip
-
-def hex2addr(hex_addr):
-    l = len(hex_addr)
-    first = True
-    ip = ""
-    for i in range(l // 2):
-        if (first != True):
-            ip = "%s." % ip
-        else:
-            first = False
-        ip = ip + ("%d" % int(hex_addr[-2:], 16))
-        hex_addr = hex_addr[:-2]
+                self.netlink.recv(65536)
+                changed = True
+            except BlockingIOError:
+                return changed
+            except OSError:
+                # ENOBUFS, notifications were dropped so assume something changed
+                return True
+
+    def get(self):
+        with self.lock:
+            if self.watch and self.netlink is None and self.tables is None:
+                # Subscribe before the first read, a change in between is then not missed
+                self.subscribe()
+            elif self.netlink is not None and self.tables is not None and not self.changed():
+                return self.address
+            tables = (read_file(self.route_path), read_file(self.fib_trie_path))
+            if tables != self.tables:
+                self.tables = tables
+                self.address = select_host_address(parse_routes(tables[0]), parse_local_addresses(tables[1]))
+            return self.address
+
+# In a container the host's routing tables are mounted from /proc/1/net, otherwise the own ones are read
+host_address = HostAddress('/app/host/proc/net', watch=False) if isDockerized and isHostRoutes else HostAddress()
+
+def get_host_ip():
+    try:
+        ip = host_address.get()
+    except OSError as e:
+        print('Error while trying to read the routing tables with exception: ' + str(e))
+        ip = None
+    if ip is None:
+        try:
+            return socket.gethostbyname(socket.gethostname())
+        except socket.gaierror:
+            return '127.0.0.1'
     return ip
 
 def get_host_os():
     try:
-        return OS_DATA['PRETTY_NAME']
+        return get_os_data()['PRETTY_NAME']
     except:
         return 'Unknown'
 
@@ -342,6 +828,53 @@ def external_drive_base(drive, drive_path) -> dict:
         'function': lambda: get_disk_usage(f'{drive_path}')
         }
 
+# Builds an upload or download entry for a single network interface
+def interface_base(interface, direction) -> dict:
+    return {
+        'name': f'Network {"Upload" if direction == "tx" else "Download"} {interface}',
+        'state_class': 'measurement',
+        'unit': 'Kbps',
+        'icon': 'server-network',
+        'sensor_type': 'sensor',
+        'function': lambda: get_net_data_tx(interface) if direction == 'tx' else get_net_data_rx(interface)
+        }
+
+# Builds a read or write throughput entry for a block device in /proc/diskstats
+def disk_io_base(disk, direction) -> dict:
+    return {
+        'name': f'Disk {direction.capitalize()} {disk}',
+        'class': 'data_rate',
+        'state_class': 'measurement',
+        'unit': 'kB/s',
+        'icon': 'harddisk',
+        'sensor_type': 'sensor',
+        'function': lambda: get_disk_read(disk) if direction == 'read' else get_disk_write(disk)
+        }
+
+# Builds an entry publishing a statistic over the sample window of a high frequency sensor
+def statistic_base(attr, statistic, window) -> dict:
+    entry = {key: attr[key] for key in ['class', 'state_class', 'unit', 'icon'] if key in attr}
+    entry.update({
+        'name': f"{attr['name']} {statistic.upper() if statistic.startswith('p') else statistic.capitalize()}",
+        'sensor_type': 'sensor',
+        'function': lambda: window.aggregate(statistic)
+        })
+    return entry
+
+# Builds an entry for one temperature or fan input of a hwmon chip or thermal zone
+def hwmon_base(hwmon_input, kind) -> dict:
+    entry = {
+        'name': f'{"Temperature" if kind == "temp" else "Fan Speed"} {hwmon_input.chip} {hwmon_input.label}',
+        'state_class': 'measurement',
+        'unit': '°C' if kind == 'temp' else 'rpm',
+        'icon': 'thermometer' if kind == 'temp' else 'fan',
+        'sensor_type': 'sensor',
+        'function': lambda: read_hwmon_input(hwmon_input, kind)
+        }
+    if kind == 'temp':
+        entry['class'] = 'temperature'
+    return entry
+
 # Builds a zpool entry to fix incorrect usage reporting
 def zpool_base(pool) -> dict:
     return {
@@ -373,6 +906,8 @@ sensors = {
                  'icon': 'monitor',
                  'sensor_type': 'switch',
                  'function': get_display_status,
+                 'command': display_command,
+                 'parse': parse_display_status,
                  'prop': PropertyBag({
                      'command_topic'      : 'system-sensors/sensor/{device_name}/command',
                      'state_off'          : '0',
@@ -459,26 +994,31 @@ sensors = {
                  'class': 'timestamp',
                  'icon': 'clock',
                  'sensor_type': 'sensor',
+                 'category': 'static',
                  'function': get_last_boot},
           'hostname':
                 {'name': 'Hostname',
                  'icon': 'card-account-details',
                  'sensor_type': 'sensor',
+                 'category': 'static',
                  'function': get_hostname},
           'host_ip':
                 {'name': 'Host IP',
                  'icon': 'lan',
                  'sensor_type': 'sensor',
+                 'category': 'slow',
                  'function': get_host_ip},
           'host_os':
                 {'name': 'Host OS',
                  'icon': 'linux',
                  'sensor_type': 'sensor',
+                 'category': 'static',
                  'function': get_host_os},
           'host_arch':
                 {'name': 'Host Architecture',
                  'icon': 'chip',
                  'sensor_type': 'sensor',
+                 'category': 'static',
                  'function': get_host_arch},
           'last_message':
                 {'name': 'Last Message',
@@ -490,6 +1030,7 @@ sensors = {
                 {'name':'Updates',
                  'icon': 'cellphone-arrow-down',
                  'sensor_type': 'sensor',
+                 'category': 'slow',
                  'function': get_updates},
           'wifi_strength':
                 {'class': 'signal_strength',
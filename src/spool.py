@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Bounded on-disk store for state messages taken while the broker is unreachable.
+#
+# The spool is a fixed size, memory-mapped ring file. Records are appended at
+# the tail and the oldest records are dropped when the file is full, so it never
+# grows past its size. Head and tail are absolute positions stored in the header,
+# the spool survives a restart of the process.
+
+import os
+import mmap
+import time
+import struct
+
+HEADER = struct.Struct('<4sQQQ')
+MAGIC = b'SSP1'
+LENGTH = struct.Struct('<I')
+RECORD = struct.Struct('<dBH')
+
+class Spool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size - HEADER.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            new = os.fstat(fd).st_size != size
+            if new:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, self.head, self.tail, self.dropped = HEADER.unpack_from(self.map, 0)
+        if new or magic != MAGIC or self.tail - self.head > self.size:
+            self.head = self.tail = self.dropped = 0
+            self.write_header()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.head, self.tail, self.dropped)
+
+    def write(self, position, data):
+        offset = position % self.size
+        first = min(len(data), self.size - offset)
+        self.map[HEADER.size + offset:HEADER.size + offset + first] = data[:first]
+        if first < len(data):
+            self.map[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def read(self, position, length):
+        offset = position % self.size
+        first = min(length, self.size - offset)
+        data = self.map[HEADER.size + offset:HEADER.size + offset + first]
+        if first < length:
+            data += self.map[HEADER.size:HEADER.size + length - first]
+        return data
+
+    def append(self, topic, payload, retain=False, timestamp=None):
+        topic = topic.encode('utf-8')
+        payload = payload.encode('utf-8') if isinstance(payload, str) else payload
+        record = RECORD.pack(time.time() if timestamp is None else timestamp, retain, len(topic)) + topic + payload
+        if LENGTH.size + len(record) > self.size:
+            return False
+        # Make room by dropping the oldest records
+        while self.size - len(self) < LENGTH.size + len(record):
+            self.head += LENGTH.size + LENGTH.unpack(self.read(self.head, LENGTH.size))[0]
+            self.dropped += 1
+        self.write(self.tail, LENGTH.pack(len(record)) + record)
+        self.tail += LENGTH.size + len(record)
+        self.write_header()
+        return True
+
+    def pop(self):
+        """Remove and return the oldest record as (timestamp, topic, payload, retain)."""
+        if not len(self):
+            return None
+        length = LENGTH.unpack(self.read(self.head, LENGTH.size))[0]
+        record = self.read(self.head + LENGTH.size, length)
+        self.head += LENGTH.size + length
+        if self.head == self.tail:
+            # Start over at the beginning of the file once empty
+            self.head = self.tail = 0
+        self.write_header()
+        timestamp, retain, topic_length = RECORD.unpack_from(record)
+        topic = record[RECORD.size:RECORD.size + topic_length].decode('utf-8')
+        return timestamp, topic, record[RECORD.size + topic_length:], bool(retain)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+def select_records(records, policy, downsample=300):
+    """Apply the replay policy to a list of (timestamp, topic, payload, retain) records."""
+    if policy == 'latest':
+        latest = {}
+        for record in records:
+            latest[record[1]] = record
+        return sorted(latest.values(), key=lambda record: record[0])
+    if policy == 'downsample':
+        kept = []
+        last_kept = {}
+        for record in records:
+            if record[1] not in last_kept or record[0] - last_kept[record[1]] >= downsample:
+                kept.append(record)
+                last_kept[record[1]] = record[0]
+        return kept
+    return records
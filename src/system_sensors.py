@@ -5,20 +5,81 @@ import sys
 import time
 import yaml
 import signal
+import json
+import math
+import heapq
+import random
+import zoneinfo
 import pathlib
 import argparse
 import threading
+import concurrent.futures
 import paho.mqtt.client as mqtt
-import importlib.metadata
 
 from sensors import *
+from guests import guest_sensors, guest_kinds, collect_guests, get_guest_name
+from spool import Spool, select_records
+# asyncio and the metrics endpoint are imported in main, only when they are enabled
 
 
 mqttClient = None
+manager = None
+job = None
 global poll_interval
+slow_interval = 600
+sensor_timeout = 10
+heartbeat_interval = 600
 devicename = None
 settings = {}
 external_drives = []
+# Per interface and per disk sensors from the interfaces and disks settings
+extra_sensors = []
+# Last collected value of every enabled sensor, sensors that are not due keep their previous value
+sensor_values = {}
+# Sensors whose last reading timed out or failed, their previous value is published
+stale_sensors = set()
+# Sensors still running on the worker pool, they are not submitted again until they finish
+in_flight = {}
+# Sample windows of the sensors read at sample_interval, their statistics are published as extra sensors
+samplers = {}
+executor = None
+last_cycle_time = 0
+# Monotonic time the last collection finished, scrapes of the metrics endpoint are served from it
+last_collection = 0
+metrics_server = None
+# Event loop of the asyncio runtime
+event_loop = None
+# Wall time of the last read of every sensor, published by the self metrics
+sensor_durations = {}
+process = None
+update_lock = threading.Lock()
+# Takes the place of update_lock in the asyncio runtime
+async_update_lock = None
+values_lock = threading.Lock()
+# Values and stale list of the last state message, used for deadbands and to skip unchanged messages
+published_values = {}
+published_stale = []
+last_publish = 0
+# Latest values and names of the running Proxmox guests, {guest id: (kind, {sensor: value})}
+guest_values = {}
+guest_names = {}
+# Cached discovery messages and the retained discovery messages the broker holds for this device
+config_messages = {}
+config_key = None
+retained_config = {}
+discovery_limiter = None
+rediscovery_timer = None
+rediscovery_lock = threading.Lock()
+# Set while the broker connection is up
+connected = threading.Event()
+# State messages taken while the broker is unreachable, replayed after reconnecting
+spool = None
+replaying = False
+spool_lock = threading.Lock()
+# Bounds the state messages handed to paho, see OutboundQueue
+outbound = None
+# Set by SIGHUP to re-read the static sensors
+static_refresh = threading.Event()
 
 class ProgramKilled(Exception):
     pass
@@ -26,81 +87,858 @@ class ProgramKilled(Exception):
 def signal_handler(signum, frame):
     raise ProgramKilled
 
-class Job(threading.Thread):
-    def __init__(self, interval, execute, *args, **kwargs):
+def refresh_handler(signum, frame):
+    static_refresh.set()
+
+class Scheduler(threading.Thread):
+    """Run each sensor on its own interval from a single deadline-ordered queue."""
+    def __init__(self, execute):
         threading.Thread.__init__(self)
         self.daemon = False
         self.stopped = threading.Event()
-        self.interval = interval
         self.execute = execute
-        self.args = args
-        self.kwargs = kwargs
+        self.intervals = {}
+        self.queue = []
+        # Deadlines missed by a full interval, because a previous run took too long
+        self.overruns = 0
+
+    def add(self, sensor, interval):
+        self.intervals[sensor] = interval
+        heapq.heappush(self.queue, (time.monotonic() + interval, sensor))
 
     def stop(self):
         self.stopped.set()
         self.join()
 
+    def pop_due(self):
+        now = time.monotonic()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            deadline, sensor = heapq.heappop(self.queue)
+            due.append(sensor)
+            # Keep the schedule anchored to the previous deadline, unless we fell behind a full interval
+            deadline += self.intervals[sensor]
+            if deadline <= now:
+                deadline = now + self.intervals[sensor]
+                self.overruns += 1
+            heapq.heappush(self.queue, (deadline, sensor))
+        return due
+
     def run(self):
-        while not self.stopped.wait(self.interval.total_seconds()):
-            self.execute(*self.args, **self.kwargs)
+        while self.queue and not self.stopped.wait(max(0, self.queue[0][0] - time.monotonic())):
+            due = self.pop_due()
+            try:
+                self.execute(due)
+            except Exception as e:
+                write_message_to_console('Error while updating sensors ' + str(due) + ' with exception: ' + str(e))
 
+    async def run_async(self):
+        """Same schedule as run, on the running event loop, with a coroutine as execute."""
+        while self.queue:
+            await asyncio.sleep(max(0, self.queue[0][0] - time.monotonic()))
+            due = self.pop_due()
+            try:
+                await self.execute(due)
+            except Exception as e:
+                write_message_to_console('Error while updating sensors ' + str(due) + ' with exception: ' + str(e))
 
 
-def update_sensors():
-    payload_str = f'{{'
-    for sensor, attr in sensors.items():
-        # Skip sensors that have been disabled or are missing
-        if sensor in external_drives:
-            payload_str += f'"{sensor}": "{attr["function"]()}",'
-        elif settings['sensors'][sensor] is not None:
-            if settings['sensors'][sensor] == True:
-                payload_str += f'"{sensor}": "{attr["function"]()}",'
-            elif settings['sensors'][sensor] is not False:
-                payload_str += f'"{sensor}": "{attr["function"](settings["sensors"][sensor])}",'
-
-    payload_str = payload_str[:-1]
-    payload_str += f'}}'
-    mqttClient.publish(
-        topic=f'system-sensors/{attr["sensor_type"]}/{devicename}/state',
-        payload=payload_str,
-        qos=1,
-        retain=False,
-    )
+class ConnectionManager(threading.Thread):
+    """Connect to the broker and run the network loop, retrying with jittered exponential backoff."""
+    def __init__(self, client, host, port, floor, ceiling):
+        threading.Thread.__init__(self, name='mqtt', daemon=True)
+        self.client = client
+        self.host = host
+        self.port = port
+        self.floor = floor
+        self.ceiling = ceiling
+        self.stopped = threading.Event()
+        # Connection state, for logging and instrumentation
+        self.state = 'connecting'
+        self.attempts = 0
+        self.reconnects = 0
+        self.started = time.monotonic()
+        self.connected_at = None
 
+    def stop(self, timeout=5):
+        # Disconnecting ends the network loop once everything queued, like the offline message, is sent.
+        # A connect blocked on an unreachable broker is not waited for, the thread is a daemon
+        self.stopped.set()
+        self.client.disconnect()
+        self.join(timeout)
 
-def send_config_message(mqttClient):
+    def next_delay(self):
+        self.state = 'backoff'
+        # Full jitter, so a fleet that lost the broker at the same time doesn't come back in lockstep
+        delay = random.uniform(self.floor, min(self.ceiling, self.floor * 2 ** min(self.attempts, 20)))
+        self.attempts += 1
+        return delay
 
-    write_message_to_console('Sending config message to host...')
+    def backoff(self):
+        self.stopped.wait(self.next_delay())
+
+    def mark_connected(self):
+        """Called from on_connect once the broker accepted the session."""
+        if self.connected_at is None:
+            write_message_to_console(f'Broker reachable {time.monotonic() - self.started:.1f}s after start')
+        else:
+            self.reconnects += 1
+        self.connected_at = time.monotonic()
+        self.state = 'connected'
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.state = 'connecting'
+            previous = self.connected_at
+            try:
+                self.client.connect(self.host, self.port)
+            except OSError as e:
+                write_message_to_console(f'Could not connect to broker: {e}')
+                self.backoff()
+                continue
+            except Exception as e:
+                # Anything else would end this thread and leave the script without a broker for good
+                write_message_to_console(f'Error while connecting to broker: {e}')
+                self.backoff()
+                continue
+            if self.stopped.is_set():
+                self.client.disconnect()
+            while self.client.loop(timeout=1.0) == mqtt.MQTT_ERR_SUCCESS:
+                # A session that stayed up for a while starts the next backoff from the floor again,
+                # a refused one never reaches on_connect and keeps backing off
+                if self.attempts and self.connected_at != previous and time.monotonic() - self.connected_at > self.ceiling:
+                    self.attempts = 0
+            if not self.stopped.is_set():
+                self.backoff()
+
+    async def run_async(self, sockets):
+        """Connect and reconnect from the event loop, the socket itself is served by LoopSockets."""
+        loop = asyncio.get_running_loop()
+        while not self.stopped.is_set():
+            self.state = 'connecting'
+            previous = self.connected_at
+            sockets.closed.clear()
+            try:
+                # Name resolution and the TCP/TLS handshake block, keep them off the loop
+                await loop.run_in_executor(None, self.client.connect, self.host, self.port)
+            except OSError as e:
+                write_message_to_console(f'Could not connect to broker: {e}')
+                await asyncio.sleep(self.next_delay())
+                continue
+            except Exception as e:
+                write_message_to_console(f'Error while connecting to broker: {e}')
+                await asyncio.sleep(self.next_delay())
+                continue
+            await sockets.closed.wait()
+            if self.connected_at != previous and time.monotonic() - self.connected_at > self.ceiling:
+                self.attempts = 0
+            if not self.stopped.is_set():
+                await asyncio.sleep(self.next_delay())
+
+
+class LoopSockets:
+    """Serve a paho client's socket from an asyncio event loop instead of a network thread."""
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.sock = None
+        self.misc = None
+        self.closed = asyncio.Event()
+        # Paho calls these from whichever thread uses the client, readers and writers may only change on the loop
+        client.on_socket_open = lambda client, userdata, sock: self.call(self.socket_open, sock)
+        client.on_socket_close = lambda client, userdata, sock: self.call(self.socket_close, sock, sock.fileno())
+        client.on_socket_register_write = lambda client, userdata, sock: self.call(self.register_write, sock)
+        client.on_socket_unregister_write = lambda client, userdata, sock: self.call(self.unregister_write, sock)
+
+    def call(self, function, *args):
+        # On the loop thread right away, paho closes the socket as soon as the callback returns
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def socket_open(self, sock):
+        if sock.fileno() == -1:
+            return
+        self.sock = sock
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def socket_close(self, sock, fd):
+        try:
+            if sock is self.sock:
+                self.sock = None
+                self.misc.cancel()
+                # Closed already when the close came from another thread
+                for remove in [self.loop.remove_reader, self.loop.remove_writer]:
+                    try:
+                        remove(fd)
+                    except (OSError, ValueError):
+                        pass
+        finally:
+            self.closed.set()
+
+    def register_write(self, sock):
+        if sock is self.sock and sock.fileno() != -1:
+            self.loop.add_writer(sock, self.client.loop_write)
+
+    def unregister_write(self, sock):
+        if sock is self.sock and sock.fileno() != -1:
+            self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries, what loop() does between reads
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class TokenBucket:
+    """Allow rate operations per second on average, with bursts of up to burst operations."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+def message_done(info):
+    try:
+        return info.is_published()
+    except (RuntimeError, ValueError):
+        # Raised for messages paho refused, those are not in flight
+        return True
+
+class OutboundQueue:
+    """Hand at most max_inflight state messages to the MQTT client at a time.
+
+    The others wait here with only the newest payload kept per topic, and the oldest
+    topic is dropped once more than max_queued topics are waiting. Messages published
+    directly on the client, like discovery and availability, are left alone.
+    """
+    def __init__(self, client, max_inflight, max_queued):
+        self.client = client
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.inflight = []
+        self.sending = 0
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def queued(self):
+        """State messages waiting here or handed to the client and not acknowledged yet, on_publish prunes the latter."""
+        with self.lock:
+            return len(self.pending) + len(self.inflight) + self.sending
+
+    def put(self, topic, payload, retain=False):
+        with self.lock:
+            if topic in self.pending:
+                # Keeps its place in the queue, only the payload is replaced
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_queued:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[topic] = (payload, retain)
+        self.flush()
+
+    def reset(self):
+        # paho sends the unacknowledged messages again itself after reconnecting
+        with self.lock:
+            self.inflight = []
+        self.flush()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                self.inflight = [info for info in self.inflight if not message_done(info)]
+                if (not connected.is_set() or not self.pending
+                        or len(self.inflight) + self.sending >= self.max_inflight):
+                    return
+                topic, (payload, retain) = self.pending.popitem(last=False)
+                self.sending += 1
+            # Not under the lock, paho calls on_publish with its own lock held
+            try:
+                info = self.client.publish(topic=topic, payload=payload, qos=1, retain=retain)
+            finally:
+                with self.lock:
+                    self.sending -= 1
+            with self.lock:
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.inflight.append(info)
+                    continue
+                # The connection dropped before on_disconnect cleared connected, unless a newer
+                # payload arrived meanwhile this one goes back to the front of the queue
+                if topic in self.pending:
+                    pass
+                elif len(self.pending) >= self.max_queued:
+                    self.dropped += 1
+                else:
+                    self.pending[topic] = (payload, retain)
+                    self.pending.move_to_end(topic, last=False)
+                return
+
+
+def encode_value(value):
+    """Encode a sensor value as JSON, keeping numbers numeric and escaping strings."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return 'null'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return json.dumps(value)
+
+class PayloadSerializer:
+    """Serialize a fixed set of sensors to a JSON object, the key layout is built once and reused."""
+    def __init__(self, keys):
+        self.keys = keys
+        self.template = []
+        for index, key in enumerate(keys):
+            self.template.append(('{' if index == 0 else ',') + json.dumps(key) + ':')
+            self.template.append('null')
+        self.template.append('}' if keys else '{}')
+
+    def serialize(self, values):
+        # A copy per call, the serializer is shared by the network thread, the main thread and the workers
+        parts = list(self.template)
+        for index, key in enumerate(self.keys):
+            parts[2 * index + 1] = encode_value(values[key])
+        return ''.join(parts)
+
+serializers = {}
+
+def serialize_payload(values):
+    keys = tuple(values)
+    if keys not in serializers:
+        serializers[keys] = PayloadSerializer(keys)
+    return serializers[keys].serialize(values)
+
+
+def publish_state(topic, payload, retain=False):
+    """Publish a state message, or spool it while the broker is unreachable or older messages are still being replayed."""
+    if spool is not None:
+        with spool_lock:
+            if not connected.is_set() or replaying or len(spool):
+                spool.append(topic, payload, retain)
+                return
+    if outbound is not None:
+        outbound.put(topic, payload, retain)
+        return
+    mqttClient.publish(topic=topic, payload=payload, qos=1, retain=retain)
+
+def replay_spool():
+    """Replay the spooled messages in rate limited batches, until the spool stays empty."""
+    global replaying
+    limiter = TokenBucket(settings['spool']['replay_rate'], max(1, settings['spool']['replay_rate']))
+    while True:
+        with spool_lock:
+            records = []
+            while connected.is_set() and len(spool):
+                records.append(spool.pop())
+            if not records:
+                replaying = False
+                return
+        records = select_records(records, settings['spool']['policy'], settings['spool']['downsample'])
+        write_message_to_console(f'Replaying {len(records)} spooled messages')
+        for timestamp, topic, payload, retain in records:
+            limiter.acquire()
+            mqttClient.publish(topic=topic, payload=payload, qos=1, retain=retain)
+
+def start_replay():
+    global replaying
+    with spool_lock:
+        if replaying or not len(spool):
+            return
+        replaying = True
+    threading.Thread(target=replay_spool, name='replay', daemon=True).start()
+
+
+def get_sensor_option(sensor, option, default=None):
+    options = settings['sensor_options'].get(sensor) or {}
+    return options.get(option, sensors[sensor].get(option, default))
+
+def is_added_sensor(sensor):
+    return sensor in external_drives or sensor in extra_sensors
+
+def sensor_enabled(sensor):
+    if is_added_sensor(sensor):
+        return True
+    return settings['sensors'][sensor] is not None and settings['sensors'][sensor] is not False
+
+def enabled_sensors():
+    return [sensor for sensor in sensors if sensor_enabled(sensor)]
+
+# Static sensors are read once at startup and only re-read on SIGHUP,
+# slow sensors default to slow_interval, everything else is dynamic
+def get_sensor_category(sensor):
+    return get_sensor_option(sensor, 'category', 'dynamic')
+
+def is_publish_stamp(sensor):
+    # Timestamps like last_message change every cycle, they tell when a message went out instead
+    return sensors[sensor].get('class') == 'timestamp' and get_sensor_category(sensor) != 'static'
+
+def periodic_sensors():
+    return [sensor for sensor in enabled_sensors() if get_sensor_category(sensor) != 'static' and sensor not in samplers]
+
+def get_sensor_interval(sensor):
+    return get_sensor_option(sensor, 'interval', slow_interval if get_sensor_category(sensor) == 'slow' else poll_interval)
+
+def get_state_topic(sensor):
+    if settings['per_sensor_topics']:
+        return f'system-sensors/sensor/{devicename}/state/{sensor}'
+    if get_sensor_category(sensor) == 'static':
+        return f'system-sensors/sensor/{devicename}/static'
+    return f'system-sensors/sensor/{devicename}/state'
+
+def publish_sensor_values(values, previous, retain=False):
+    """Publish every sensor whose value differs from previous to its own topic."""
+    for sensor, value in values.items():
+        if sensor not in previous or previous[sensor] != value:
+            # Plain strings are sent as is, consumers of a single topic don't need to parse JSON
+            publish_state(get_state_topic(sensor), value if isinstance(value, str) else encode_value(value), retain)
+
+def read_sensor(sensor):
+    start = time.monotonic()
+    try:
+        if is_added_sensor(sensor) or settings['sensors'][sensor] == True:
+            return sensors[sensor]['function']()
+        return sensors[sensor]['function'](settings['sensors'][sensor])
+    finally:
+        sensor_durations[sensor] = time.monotonic() - start
+
+def sensor_done(sensor, future):
+    with values_lock:
+        in_flight.pop(sensor, None)
+        if future.cancelled():
+            stale_sensors.add(sensor)
+            return
+        if future.exception() is not None:
+            write_message_to_console('An error was produced while reading ' + sensor + ' with exception: ' + str(future.exception()))
+            stale_sensors.add(sensor)
+        else:
+            # Also stores results that arrive after their timeout, they go out with the next publish
+            sensor_values[sensor] = future.result()
+            stale_sensors.discard(sensor)
+
+def collect_sensors(due):
+    """Read the due sensors on the worker pool, waiting at most each sensor's timeout."""
+    global last_cycle_time, last_collection
+    start = time.monotonic()
+    new_snapshot()
+    if executor is None:
+        for sensor in due:
+            sensor_values[sensor] = read_sensor(sensor)
+    else:
+        futures = []
+        with values_lock:
+            for sensor in due:
+                if sensor in in_flight:
+                    stale_sensors.add(sensor)
+                    continue
+                in_flight[sensor] = executor.submit(read_sensor, sensor)
+                futures.append((start + get_sensor_option(sensor, 'timeout', sensor_timeout), sensor, in_flight[sensor]))
+        for sensor_deadline, sensor, future in sorted(futures, key=lambda f: f[0]):
+            concurrent.futures.wait([future], timeout=max(0, sensor_deadline - time.monotonic()))
+            # Runs right away for finished sensors, or whenever a timed out one completes
+            future.add_done_callback(lambda f, sensor=sensor: sensor_done(sensor, f))
+            with values_lock:
+                if not future.done():
+                    stale_sensors.add(sensor)
+    last_cycle_time = time.monotonic() - start
+    last_collection = time.monotonic()
+    if settings['report_timings']:
+        write_message_to_console(f'Collected {len(due)} sensors in {last_cycle_time:.3f}s, stale: {sorted(stale_sensors)}')
+
+def sample_sensors(due):
+    """Take one sample of each due high frequency sensor, the latest sample is its published value."""
+    # Its own snapshot and rate engines, sharing the cycle's would mix two snapshots into the running cycle
+    local_snapshot.snapshot = Snapshot()
+    local_snapshot.rates = sampler_rates
+    try:
+        for sensor in due:
+            try:
+                value = read_sensor(sensor)
+            except Exception as e:
+                write_message_to_console('An error was produced while sampling ' + sensor + ' with exception: ' + str(e))
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                samplers[sensor].add(value)
+            with values_lock:
+                sensor_values[sensor] = value
+                stale_sensors.discard(sensor)
+    finally:
+        local_snapshot.snapshot = None
+        local_snapshot.rates = {}
+
+def refresh_metrics():
+    """Collect all periodic sensors for a scrape whose data is too old."""
+    if event_loop is not None:
+        asyncio.run_coroutine_threadsafe(refresh_metrics_async(), event_loop).result()
+        return
+    with update_lock:
+        collect_sensors(periodic_sensors())
+
+def get_metric_families():
+    """Numeric values as gauges, static and slow strings as labels of an info metric."""
+    gauges = []
+    info = {'device': devicename}
+    with values_lock:
+        values = dict(sensor_values)
+        stale = sorted(stale_sensors)
+    for sensor, value in values.items():
+        if sensor not in sensors or value is None:
+            continue
+        if isinstance(value, (int, float)):
+            unit = f" ({sensors[sensor]['unit']})" if 'unit' in sensors[sensor] else ''
+            gauges.append((sensor, sensors[sensor]['name'] + unit, [({'device': devicename}, value)]))
+        elif get_sensor_category(sensor) != 'dynamic':
+            # Changing strings like last_message would start a new series on every scrape
+            info[sensor] = value
+    if stale:
+        gauges.append(('stale', 'Sensors whose last reading failed or timed out', [({'device': devicename, 'sensor': sensor}, 1) for sensor in stale]))
+    guest_gauges = {}
+    for guest, (kind, guest_sensor_values) in guest_values.items():
+        for sensor, value in guest_sensor_values.items():
+            labels = {'device': devicename, 'guest': guest, 'kind': kind, 'name': guest_names.get(guest) or guest}
+            guest_gauges.setdefault(sensor, []).append((labels, value))
+    for sensor, samples in guest_gauges.items():
+        gauges.append((f'guest_{sensor}', f"Guest {guest_sensors[sensor]['name']}", samples))
+    return gauges, [('host', 'Host information', info)]
+
+def static_sensors():
+    return [sensor for sensor in enabled_sensors() if get_sensor_category(sensor) == 'static']
+
+def publish_static_sensors(static, previous, force=False):
+    if not force and all(sensor_values.get(sensor) == previous[sensor] for sensor in static):
+        return
+    with values_lock:
+        values = {sensor: sensor_values[sensor] for sensor in static if sensor in sensor_values}
+    if settings['per_sensor_topics']:
+        publish_sensor_values(values, {} if force else previous, retain=True)
+        return
+    publish_state(f'system-sensors/sensor/{devicename}/static', serialize_payload(values), retain=True)
+
+def refresh_static_sensors(force=False):
+    """Re-read the static sensors, their retained message is only sent again when a value changed or when forced."""
+    static = static_sensors()
+    if not static:
+        return
+    with update_lock:
+        previous = {sensor: sensor_values.get(sensor) for sensor in static}
+        collect_sensors(static)
+        publish_static_sensors(static, previous, force)
 
+def update_guests(due=None):
+    """Publish every running Proxmox guest as its own device, discovery is resent when guests start or stop."""
+    global guest_values
+    guests = collect_guests(settings['guests']['cgroup_root'])
+    for guest in guest_values.keys() - guests.keys():
+        mqttClient.publish(f'system-sensors/guest/{devicename}/{guest}/availability', 'offline', retain=True)
+    for guest in guests.keys() - guest_values.keys():
+        if guest not in guest_names:
+            guest_names[guest] = get_guest_name(settings['guests']['pve_root'], guest, guests[guest][0])
+        mqttClient.publish(f'system-sensors/guest/{devicename}/{guest}/availability', 'online', retain=True)
+        if settings['discovery'] == 'device':
+            mqttClient.subscribe(f'homeassistant/device/{devicename}_{guest}/config')
+    changed = {guest: (kind, list(values)) for guest, (kind, values) in guests.items()} != \
+              {guest: (kind, list(values)) for guest, (kind, values) in guest_values.items()}
+    guest_values = guests
+    if changed:
+        send_config_message(mqttClient)
+    for guest, (kind, values) in guests.items():
+        publish_state(f'system-sensors/guest/{devicename}/{guest}/state', serialize_payload(values))
+
+def within_deadband(sensor, value):
+    """Check whether a value moved less than the sensor's deadband since it was last published."""
+    deadband = get_sensor_option(sensor, 'deadband')
+    if deadband is None or sensor not in published_values:
+        return False
+    try:
+        value = float(value)
+        previous = float(published_values[sensor])
+        if isinstance(deadband, str) and deadband.endswith('%'):
+            return abs(value - previous) < abs(previous) * float(deadband[:-1]) / 100
+        return abs(value - previous) < float(deadband)
+    except (TypeError, ValueError):
+        return False
+
+def publish_sensors():
+    """Publish the collected values, unless nothing changed since the last publish."""
+    global published_values, published_stale, last_publish
+    heartbeat = time.monotonic() - last_publish >= heartbeat_interval
+    values = {}
+    stamps = []
+    with values_lock:
+        for sensor in sensors:
+            if sensor in sensor_values and is_publish_stamp(sensor):
+                stamps.append(sensor)
+            elif sensor in sensor_values and get_sensor_category(sensor) != 'static':
+                # Small moves keep the published value so HA sees no state change
+                if not heartbeat and within_deadband(sensor, sensor_values[sensor]):
+                    values[sensor] = published_values[sensor]
+                else:
+                    values[sensor] = sensor_values[sensor]
+        stale = sorted(stale_sensors)
+    if not heartbeat and values == {sensor: value for sensor, value in published_values.items() if sensor not in stamps} \
+            and stale == published_stale:
+        return
+    for sensor in stamps:
+        values[sensor] = read_sensor(sensor)
+    previous = {} if heartbeat else published_values
+    previous_stale = None if heartbeat else published_stale
+    published_values = values
+    published_stale = stale
+    last_publish = time.monotonic()
+
+    if settings['per_sensor_topics']:
+        publish_sensor_values(values, previous)
+        if stale != previous_stale:
+            publish_state(f'system-sensors/sensor/{devicename}/stale', json.dumps(stale))
+        return
+    if stale:
+        values = dict(values, stale=stale)
+    publish_state(f'system-sensors/sensor/{devicename}/state', serialize_payload(values))
+
+def update_sensors(due=None):
+    with update_lock:
+        collect_sensors(periodic_sensors() if due is None else due)
+        publish_sensors()
+
+async def run_command(command, timeout):
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise asyncio.TimeoutError(f'{command[0]} did not finish within {timeout}s') from None
+    return stdout.decode('utf-8')
+
+async def read_sensor_async(sensor):
+    # Sensors that shell out run as child processes watched by the loop, the others on the worker pool
+    command = sensors[sensor].get('command')
+    command = command() if command is not None else None
+    if command is None:
+        return await asyncio.get_running_loop().run_in_executor(executor, read_sensor, sensor)
+    start = time.monotonic()
+    try:
+        return sensors[sensor]['parse'](await run_command(command, get_sensor_option(sensor, 'timeout', sensor_timeout)))
+    finally:
+        sensor_durations[sensor] = time.monotonic() - start
+
+async def collect_sensors_async(due):
+    """Like collect_sensors, on the running event loop."""
+    global last_cycle_time, last_collection
+    start = time.monotonic()
+    new_snapshot()
+    futures = []
+    with values_lock:
+        for sensor in due:
+            if sensor in in_flight:
+                stale_sensors.add(sensor)
+                continue
+            in_flight[sensor] = asyncio.ensure_future(read_sensor_async(sensor))
+            futures.append((start + get_sensor_option(sensor, 'timeout', sensor_timeout), sensor, in_flight[sensor]))
+    for sensor_deadline, sensor, future in sorted(futures, key=lambda f: f[0]):
+        await asyncio.wait([future], timeout=max(0, sensor_deadline - time.monotonic()))
+        if future.done():
+            sensor_done(sensor, future)
+        else:
+            with values_lock:
+                stale_sensors.add(sensor)
+            future.add_done_callback(lambda f, sensor=sensor: sensor_done(sensor, f))
+    last_cycle_time = time.monotonic() - start
+    last_collection = time.monotonic()
+    if settings['report_timings']:
+        write_message_to_console(f'Collected {len(due)} sensors in {last_cycle_time:.3f}s, stale: {sorted(stale_sensors)}')
+
+async def update_sensors_async(due=None):
+    async with async_update_lock:
+        await collect_sensors_async(periodic_sensors() if due is None else due)
+        publish_sensors()
+
+async def refresh_metrics_async():
+    async with async_update_lock:
+        await collect_sensors_async(periodic_sensors())
+
+async def refresh_static_sensors_async(force=False):
+    """Like refresh_static_sensors, on the running event loop."""
+    static = static_sensors()
+    if not static:
+        return
+    async with async_update_lock:
+        previous = {sensor: sensor_values.get(sensor) for sensor in static}
+        await collect_sensors_async(static)
+        publish_static_sensors(static, previous, force)
+
+async def set_display_power_async(power):
+    await asyncio.get_running_loop().run_in_executor(None, subprocess.check_output, [vcgencmd, 'display_power', power])
+    await update_sensors_async()
+
+
+def get_entity_config(sensor, attr):
+    config = {}
+    if 'class' in attr:
+        config['device_class'] = attr['class']
+    if 'state_class' in attr:
+        config['state_class'] = attr['state_class']
+    config['name'] = attr['name']
+    config['state_topic'] = get_state_topic(sensor)
+    if 'unit' in attr:
+        config['unit_of_measurement'] = attr['unit']
+    if not settings['per_sensor_topics']:
+        config['value_template'] = f'{{{{value_json.{sensor}}}}}'
+    config['object_id'] = f'{devicename}_{attr["sensor_type"]}_{sensor}'
+    config['unique_id'] = f'{devicename}_{attr["sensor_type"]}_{sensor}'
+    if 'icon' in attr:
+        config['icon'] = f'mdi:{attr["icon"]}'
+    if 'prop' in attr:
+        config.update({key: value.replace('{device_name}', devicename) for key, value in attr['prop'].items()})
+    return config
+
+def add_device_messages(messages, node_id, device, availability, entities):
+    """Add the discovery messages of one device, entities maps object ids to (sensor_type, config)."""
+    if settings['discovery'] == 'device':
+        messages[f'homeassistant/device/{node_id}/config'] = json.dumps({
+            'device': device,
+            'origin': {'name': 'system_sensors'},
+            'availability': availability,
+            'availability_mode': 'all',
+            'components': {object_id: dict(platform=sensor_type, **config) for object_id, (sensor_type, config) in entities.items()},
+        })
+        return
+    for object_id, (sensor_type, config) in entities.items():
+        if len(availability) == 1:
+            config['availability_topic'] = availability[0]['topic']
+        else:
+            config['availability'] = availability
+            config['availability_mode'] = 'all'
+        config['device'] = device
+        messages[f'homeassistant/{sensor_type}/{devicename}/{object_id}/config'] = json.dumps(config)
+
+def get_guest_entities(guest):
+    entities = {}
+    for sensor, attr in guest_sensors.items():
+        if sensor not in guest_values[guest][1]:
+            continue
+        config = {}
+        if 'class' in attr:
+            config['device_class'] = attr['class']
+        config['state_class'] = attr['state_class']
+        config['name'] = attr['name']
+        config['state_topic'] = f'system-sensors/guest/{devicename}/{guest}/state'
+        config['unit_of_measurement'] = attr['unit']
+        config['value_template'] = f'{{{{value_json.{sensor}}}}}'
+        config['object_id'] = f'{devicename}_{guest}_{sensor}'
+        config['unique_id'] = f'{devicename}_{guest}_{sensor}'
+        config['icon'] = f'mdi:{attr["icon"]}'
+        entities[f'{guest}_{sensor}'] = (attr['sensor_type'], config)
+    return entities
+
+def build_config_messages():
+    """Build the retained discovery messages, one per sensor or a single message per device."""
+    availability = [{'topic': f'system-sensors/sensor/{devicename}/availability'}]
+    device = {
+        'identifiers': [f'{devicename}_sensor'],
+        'name': f'{deviceNameDisplay} Sensors',
+        'model': deviceModel,
+        'manufacturer': deviceManufacturer,
+    }
+    messages = {}
+    entities = {}
     for sensor, attr in sensors.items():
         try:
             # Added check in case sensor is an external drive, which is nested in the config
-            if sensor in external_drives or settings['sensors'][sensor]:
-                mqttClient.publish(
-                    topic=f'homeassistant/{attr["sensor_type"]}/{devicename}/{sensor}/config',
-                    payload = (f'{{'
-                                + (f'"device_class":"{attr["class"]}",' if 'class' in attr else '')
-                                + (f'"state_class":"{attr["state_class"]}",' if 'state_class' in attr else '')
-                                + f'"name":"{attr["name"]}",'
-                                + f'"state_topic":"system-sensors/sensor/{devicename}/state",'
-                                + (f'"unit_of_measurement":"{attr["unit"]}",' if 'unit' in attr else '')
-                                + f'"value_template":"{{{{value_json.{sensor}}}}}",'
-                                + f'"object_id":"{devicename}_{attr["sensor_type"]}_{sensor}",'
-                                + f'"unique_id":"{devicename}_{attr["sensor_type"]}_{sensor}",'
-                                + f'"availability_topic":"system-sensors/sensor/{devicename}/availability",'
-                                + f'"device":{{"identifiers":["{devicename}_sensor"],'
-                                + f'"name":"{deviceNameDisplay} Sensors","model":"{deviceModel}", "manufacturer":"{deviceManufacturer}"}}'
-                                + (f',"icon":"mdi:{attr["icon"]}"' if 'icon' in attr else '')
-                                + (f',{attr["prop"].to_string(devicename)}' if 'prop' in attr else '')
-                                + f'}}'
-                    ),
-                    qos=1,
-                    retain=True,
-                )
+            if is_added_sensor(sensor) or settings['sensors'][sensor]:
+                entities[sensor] = (attr['sensor_type'], get_entity_config(sensor, attr))
         except Exception as e:
             write_message_to_console('An error was produced while processing ' + str(sensor) + ' with exception: ' + str(e))
             print(str(settings))
             raise
+    add_device_messages(messages, devicename, device, availability, entities)
+    for guest in sorted(guest_values, key=int):
+        add_device_messages(messages, f'{devicename}_{guest}', {
+            'identifiers': [f'{devicename}_guest_{guest}'],
+            'name': guest_names[guest],
+            'model': guest_kinds[guest_values[guest][0]],
+            'manufacturer': 'Proxmox',
+            'via_device': f'{devicename}_sensor',
+        }, availability + [{'topic': f'system-sensors/guest/{devicename}/{guest}/availability'}], get_guest_entities(guest))
+    return messages
+
+def get_config_messages():
+    """Return the cached discovery messages, they are only rebuilt when the settings they depend on change."""
+    global config_messages, config_key
+    key = json.dumps([devicename, deviceNameDisplay, deviceModel, settings['discovery'], settings['per_sensor_topics'],
+                      settings['sensors'], settings['sensor_options'], external_drives, extra_sensors,
+                      {guest: (kind, list(values), guest_names[guest]) for guest, (kind, values) in guest_values.items()}],
+                     sort_keys=True, default=str)
+    if key != config_key:
+        config_messages = build_config_messages()
+        config_key = key
+    return config_messages
+
+def is_config_topic(topic):
+    return topic.startswith('homeassistant/') and topic.endswith('/config')
+
+def send_config_message(mqttClient):
+
+    write_message_to_console('Sending config message to host...')
+
+    messages = get_config_messages()
+    skipped = 0
+    for topic, payload in messages.items():
+        # The broker still holds this exact retained message, so HA rediscovers it without our help
+        if retained_config.get(topic) == payload.encode('utf-8'):
+            skipped += 1
+            continue
+        if discovery_limiter is not None:
+            discovery_limiter.acquire()
+        mqttClient.publish(topic, payload, qos=1, retain=True)
+    # Remove the messages of the other discovery format so HA doesn't see every entity twice
+    for topic, payload in list(retained_config.items()):
+        if payload and topic not in messages and (settings['discovery'] == 'device') != topic.startswith('homeassistant/device/'):
+            mqttClient.publish(topic, '', qos=1, retain=True)
+    if skipped:
+        write_message_to_console(f'Skipped {skipped} unchanged config messages')
+
+def rediscover():
+    global rediscovery_timer
+    with rediscovery_lock:
+        rediscovery_timer = None
+    try:
+        send_config_message(mqttClient)
+    except Exception as e:
+        write_message_to_console('Error while attempting to send config to MQTT host: ' + str(e))
+
+def schedule_rediscovery():
+    """Resend discovery after a random delay off the network thread, birth messages that arrive meanwhile are coalesced."""
+    global rediscovery_timer
+    with rediscovery_lock:
+        if rediscovery_timer is not None:
+            return
+        rediscovery_timer = threading.Timer(random.uniform(0, settings['rediscovery_jitter']), rediscover)
+        rediscovery_timer.daemon = True
+        rediscovery_timer.start()
 
     mqttClient.publish(f'system-sensors/sensor/{devicename}/availability', 'online', retain=True)
 
@@ -111,19 +949,72 @@ def _parser():
     return parser
 
 def set_defaults(settings):
-    global poll_interval
-    set_default_timezone(pytz.timezone(settings['timezone']))
+    global poll_interval, slow_interval, sensor_timeout, heartbeat_interval
+    set_default_timezone(zoneinfo.ZoneInfo(settings['timezone']))
     poll_interval = settings['update_interval'] if 'update_interval' in settings else 60
+    slow_interval = settings['slow_interval'] if 'slow_interval' in settings else max(poll_interval, 600)
+    sensor_timeout = settings['sensor_timeout'] if 'sensor_timeout' in settings else 10
+    heartbeat_interval = settings['heartbeat_interval'] if 'heartbeat_interval' in settings else 600
+    if 'workers' not in settings:
+        settings['workers'] = 4
+    if 'report_timings' not in settings:
+        settings['report_timings'] = False
+    if 'runtime' not in settings:
+        settings['runtime'] = 'threads'
+    if 'self_metrics' not in settings:
+        settings['self_metrics'] = False
+    if 'hwmon_inputs' not in settings:
+        settings['hwmon_inputs'] = False
+    if 'per_sensor_topics' not in settings:
+        settings['per_sensor_topics'] = False
+    if 'discovery' not in settings:
+        settings['discovery'] = 'entity'
+    if 'spool' not in settings or settings['spool'] is None:
+        settings['spool'] = {}
+    settings['spool'].setdefault('enabled', False)
+    settings['spool'].setdefault('size', 4194304)
+    settings['spool'].setdefault('policy', 'full')
+    settings['spool'].setdefault('downsample', 300)
+    settings['spool'].setdefault('replay_rate', 20)
+    if 'outbound' not in settings or settings['outbound'] is None:
+        settings['outbound'] = {}
+    settings['outbound'].setdefault('max_inflight', 20)
+    settings['outbound'].setdefault('max_queued', 500)
+    if 'guests' not in settings or settings['guests'] is None:
+        settings['guests'] = {}
+    settings['guests'].setdefault('enabled', False)
+    settings['guests'].setdefault('interval', poll_interval)
+    settings['guests'].setdefault('cgroup_root', '/sys/fs/cgroup')
+    settings['guests'].setdefault('pve_root', '/etc/pve')
+    if 'prometheus' not in settings or settings['prometheus'] is None:
+        settings['prometheus'] = {}
+    settings['prometheus'].setdefault('enabled', False)
+    settings['prometheus'].setdefault('address', '0.0.0.0')
+    settings['prometheus'].setdefault('port', 9101)
+    settings['prometheus'].setdefault('max_age', poll_interval)
+    if 'rediscovery_jitter' not in settings:
+        settings['rediscovery_jitter'] = 5
+    if 'discovery_rate' not in settings:
+        settings['discovery_rate'] = 10
     if 'port' not in settings['mqtt']:
         settings['mqtt']['port'] = 1883
+    if 'reconnect_min' not in settings['mqtt']:
+        settings['mqtt']['reconnect_min'] = 1
+    if 'reconnect_max' not in settings['mqtt']:
+        settings['mqtt']['reconnect_max'] = 300
     if 'sensors' not in settings:
         settings['sensors'] = {}
+    if 'sensor_options' not in settings or settings['sensor_options'] is None:
+        settings['sensor_options'] = {}
     for sensor in sensors:
         if sensor not in settings['sensors']:
             settings['sensors'][sensor] = True
     if 'external_drives' not in settings['sensors'] or settings['sensors']['external_drives'] is None:
         settings['sensors']['external_drives'] = {}
-    if "rasp" not in OS_DATA["ID"]:
+    for key in ['interfaces', 'disks']:
+        if key not in settings['sensors'] or settings['sensors'][key] is None:
+            settings['sensors'][key] = []
+    if "rasp" not in get_os_data()["ID"]:
         settings['sensors']['display'] = False
 
     # 'settings' argument is local, so needs to be returned to overwrite the one in the main function
@@ -141,10 +1032,10 @@ def check_settings(settings):
     if 'user' in settings['mqtt'] and 'password' not in settings['mqtt']:
         write_message_to_console('password not defined in settings.yaml! Please check the documentation')
         sys.exit()
-    if 'power_status' in settings['sensors'] and rpi_power_disabled:
+    if settings['sensors'].get('power_status') and get_under_voltage() is None:
         write_message_to_console('Unable to import rpi_bad_power library, or is incompatible on host architecture. Power supply info will not be shown.')
         settings['sensors']['power_status'] = False
-    if 'updates' in settings['sensors'] and apt_disabled:
+    if settings['sensors'].get('updates') and not apt_available():
         write_message_to_console('Unable to import apt package. Available updates will not be shown.')
         settings['sensors']['updates'] = False
     if 'power_integer_state' in settings:
@@ -155,11 +1046,38 @@ def check_settings(settings):
     if 'tls' not in settings:
         settings['tls'] = {}
         settings['tls']['ca_certs'] = ''
+    if settings['spool']['policy'] not in ['full', 'downsample', 'latest']:
+        write_message_to_console('spool policy must be full, downsample or latest, using full.')
+        settings['spool']['policy'] = 'full'
+    for option, default in [('max_inflight', 20), ('max_queued', 500)]:
+        value = settings['outbound'][option]
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            write_message_to_console(f'outbound {option} must be a positive integer, using {default}.')
+            settings['outbound'][option] = default
+    if settings['discovery'] not in ['entity', 'device']:
+        write_message_to_console('discovery must be entity or device, using entity.')
+        settings['discovery'] = 'entity'
+    if settings['runtime'] not in ['threads', 'asyncio']:
+        write_message_to_console('runtime must be threads or asyncio, using threads.')
+        settings['runtime'] = 'threads'
+    for sensor, options in settings['sensor_options'].items():
+        interval = (options or {}).get('interval')
+        if interval is not None and (not isinstance(interval, (int, float)) or interval <= 0):
+            write_message_to_console(f'Invalid interval for {sensor}, using update_interval instead.')
+            del options['interval']
+        for option in ['sample_interval', 'window']:
+            value = (options or {}).get(option)
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                write_message_to_console(f'Invalid {option} for {sensor}, ignoring it.')
+                del options[option]
+        statistics = (options or {}).get('statistics')
+        if statistics is not None and not all(is_statistic(statistic) for statistic in statistics):
+            write_message_to_console(f'Invalid statistics for {sensor}, must be min, max, mean or a percentile like p95. Using the defaults.')
+            del options['statistics']
 
 def check_zfs(mount_point):
-    for disk in psutil.disk_partitions():
-        if disk.mountpoint == mount_point and disk.fstype == 'zfs':
-            return True
+    mount = get_mounts().get(mount_point)
+    return mount is not None and mount.fstype == 'zfs'
 
 def add_drives():
     drives = settings['sensors']['external_drives']
@@ -172,24 +1090,155 @@ def add_drives():
             else:
                 usage = get_disk_usage(drive_path)
                 zfs = False
-            if usage and zfs:
+            if usage is not None and zfs:
                 sensors[f'zpool_use_{drive.lower()}'] = zpool_base(drive)
                 # Add drive to list with formatted name, for when checking sensors against settings items
                 external_drives.append(f'zpool_use_{drive.lower()}')
-            elif usage:
+            elif usage is not None:
                 sensors[f'disk_use_{drive.lower()}'] = external_drive_base(drive, drives[drive])
+                disk_usage_paths.append(drive_path)
                 # Add drive to list with formatted name, for when checking sensors against settings items
                 external_drives.append(f'disk_use_{drive.lower()}')
             else:
                 # Skip drives not found. Could be worth sending "not mounted" as the value if users want to track mount status.
                 print(drive + ' is not mounted to host. Check config or host drive mount settings.')
 
+def add_interfaces_and_disks():
+    for interface in settings['sensors']['interfaces']:
+        for direction in ['tx', 'rx']:
+            sensors[f'net_{direction}_{interface.lower()}'] = interface_base(interface, direction)
+            extra_sensors.append(f'net_{direction}_{interface.lower()}')
+    for disk in settings['sensors']['disks']:
+        for direction in ['read', 'write']:
+            sensors[f'disk_{direction}_{disk.lower()}'] = disk_io_base(disk, direction)
+            extra_sensors.append(f'disk_{direction}_{disk.lower()}')
+
+def add_hwmon_sensors():
+    set_hwmon_inputs(get_sensor_option('temperature', 'chip', None), get_sensor_option('temperature', 'label', None),
+                     get_sensor_option('fan_speed', 'chip', None), get_sensor_option('fan_speed', 'label', None))
+    for sensor, hwmon_input in [('temperature', temperature_input), ('fan_speed', fan_input)]:
+        if sensor_enabled(sensor) and hwmon_input is not None:
+            write_message_to_console(f'Reading {sensor} from {hwmon_input.chip} {hwmon_input.label}')
+    if not settings['hwmon_inputs']:
+        return
+    for kind, prefix in [('temp', 'temperature'), ('fan', 'fan_speed')]:
+        for hwmon_input in find_hwmon_inputs(kind):
+            sensor = re.sub('[^a-z0-9]+', '_', f'{prefix}_{hwmon_input.chip}_{hwmon_input.label}'.lower())
+            # Chips like nvme can be present more than once
+            name, count = sensor, 1
+            while sensor in sensors:
+                count += 1
+                sensor = f'{name}_{count}'
+            sensors[sensor] = hwmon_base(hwmon_input, kind)
+            extra_sensors.append(sensor)
+
+def add_sampled_sensors():
+    for sensor in enabled_sensors():
+        if get_sensor_option(sensor, 'sample_interval', None) is None or get_sensor_category(sensor) == 'static':
+            continue
+        window = get_sensor_option(sensor, 'window', get_sensor_interval(sensor))
+        samplers[sensor] = SampleWindow(max(1, math.ceil(window / get_sensor_option(sensor, 'sample_interval', None))))
+        for statistic in get_sensor_option(sensor, 'statistics', ['min', 'max', 'mean', 'p95']):
+            sensors[f'{sensor}_{statistic}'] = statistic_base(sensors[sensor], statistic, samplers[sensor])
+            sensors[f'{sensor}_{statistic}']['interval'] = get_sensor_interval(sensor)
+            extra_sensors.append(f'{sensor}_{statistic}')
+
+def get_queued_messages():
+    return outbound.queued() if outbound is not None else 0
+
+def get_process_memory():
+    return round(process.memory_info().rss / 1048576, 1)
+
+self_metrics = {
+    'self_cycle_time': {
+        'name': 'Collection Cycle Time',
+        'class': 'duration',
+        'state_class': 'measurement',
+        'unit': 'ms',
+        'icon': 'timer-outline',
+        'sensor_type': 'sensor',
+        'function': lambda: round(last_cycle_time * 1000, 1)},
+    'self_overruns': {
+        'name': 'Collection Overruns',
+        'state_class': 'total_increasing',
+        'icon': 'timer-alert-outline',
+        'sensor_type': 'sensor',
+        'function': lambda: job.overruns if job is not None else 0},
+    'self_queued_messages': {
+        'name': 'Queued Messages',
+        'state_class': 'measurement',
+        'icon': 'tray-full',
+        'sensor_type': 'sensor',
+        'function': get_queued_messages},
+    'self_dropped_messages': {
+        'name': 'Dropped Messages',
+        'state_class': 'total_increasing',
+        'icon': 'tray-remove',
+        'sensor_type': 'sensor',
+        'function': lambda: outbound.dropped if outbound is not None else 0},
+    'self_coalesced_messages': {
+        'name': 'Coalesced Messages',
+        'state_class': 'total_increasing',
+        'icon': 'tray-arrow-up',
+        'sensor_type': 'sensor',
+        'function': lambda: outbound.coalesced if outbound is not None else 0},
+    'self_reconnects': {
+        'name': 'Broker Reconnects',
+        'state_class': 'total_increasing',
+        'icon': 'lan-connect',
+        'sensor_type': 'sensor',
+        'function': lambda: manager.reconnects if manager is not None else 0},
+    'self_cpu_usage': {
+        'name': 'Monitor CPU Usage',
+        'state_class': 'measurement',
+        'unit': '%',
+        'icon': 'chip',
+        'sensor_type': 'sensor',
+        'function': lambda: process.cpu_percent(interval=None)},
+    'self_memory': {
+        'name': 'Monitor Memory',
+        'class': 'data_size',
+        'state_class': 'measurement',
+        'unit': 'MiB',
+        'icon': 'memory',
+        'sensor_type': 'sensor',
+        'function': get_process_memory},
+}
+
+# Builds an entry publishing how long the last read of a sensor took
+def sensor_duration_base(sensor) -> dict:
+    return {
+        'name': f"{sensors[sensor]['name']} Read Time",
+        'class': 'duration',
+        'state_class': 'measurement',
+        'unit': 'ms',
+        'icon': 'timer-outline',
+        'sensor_type': 'sensor',
+        'function': lambda: round(sensor_durations[sensor] * 1000, 3) if sensor in sensor_durations else None
+        }
+
+def add_self_metrics():
+    global process
+    process = psutil.Process()
+    # The first call only starts the measurement
+    process.cpu_percent(interval=None)
+    for sensor in [sensor for sensor in enabled_sensors() if get_sensor_category(sensor) != 'static']:
+        sensors[f'self_read_time_{sensor}'] = sensor_duration_base(sensor)
+        extra_sensors.append(f'self_read_time_{sensor}')
+    for sensor, attr in self_metrics.items():
+        sensors[sensor] = attr
+        extra_sensors.append(sensor)
+
+def report_startup():
+    startup = psutil.Process()
+    write_message_to_console(f'Started in {time.time() - startup.create_time():.2f}s, '
+                             f'RSS {startup.memory_info().rss / 1048576:.1f} MiB')
+
 # host model method depending on system distro
 def get_host_model():
-    if "rasp" in OS_DATA["ID"] and isDockerized and isDeviceTreeModel:
-        model = subprocess.check_output(["cat", "/app/host/proc/device-tree/model"]).decode("UTF-8").strip()
-        # remove a weird character breaking the json in mqtt explorer
-        model = model[:-1]
+    if "rasp" in get_os_data()["ID"] and isDockerized and isDeviceTreeModel:
+        # strip the trailing NUL byte that breaks the json in mqtt explorer
+        model = read_file('/app/host/proc/device-tree/model').strip().rstrip('\0')
     else:
         # todo find a solid way to determine sbc manufacture
         model = f'{deviceManufacturer} {deviceNameDisplay}'
@@ -198,6 +1247,9 @@ def get_host_model():
 def on_connect(client, userdata, flags, reason_code='', properties=''):
     if reason_code == 0:
         write_message_to_console('Connected to broker')
+        if manager is not None:
+            manager.mark_connected()
+        connected.set()
         print("subscribing : " + f"{ha_status}/status")
         client.subscribe(f"{ha_status}/status")
         print("subscribing : " + f"system-sensors/sensor/{devicename}/availability")
@@ -205,24 +1257,117 @@ def on_connect(client, userdata, flags, reason_code='', properties=''):
         print("subscribing : " + f"system-sensors/sensor/{devicename}/command")
         client.subscribe(f"system-sensors/sensor/{devicename}/command")#subscribe
         client.publish(f"system-sensors/sensor/{devicename}/command", "setup", retain=True)
+        # Watch our own retained discovery messages so identical ones are not sent again
+        retained_config.clear()
+        client.subscribe(f'homeassistant/+/{devicename}/+/config')
+        client.subscribe(f'homeassistant/device/{devicename}/config')
+        for guest in guest_values:
+            client.subscribe(f'homeassistant/device/{devicename}_{guest}/config')
+        # The broker may have lost the retained static message, send the values read at startup again
+        publish_static_sensors(static_sensors(), {}, force=True)
+        outbound.reset()
+        if spool is not None:
+            start_replay()
+        # Delayed so the retained discovery messages the broker holds arrive first and are not sent again
+        schedule_rediscovery()
     elif reason_code == 'Bad user name or password':
         write_message_to_console('Authentication failed.\n Exiting.')
         sys.exit()
     else:
         write_message_to_console('Connection failed')
 
+def on_publish(client, userdata, mid, *args):
+    # An acknowledgement frees room for the next queued state message
+    outbound.flush()
+
+def on_disconnect(client, userdata, *args):
+    connected.clear()
+    write_message_to_console('Disconnected from broker')
+
 def on_message(client, userdata, message):
+    if is_config_topic(message.topic):
+        retained_config[message.topic] = message.payload
+        return
     print (f'Message received: {message.payload.decode()}'  )
     if message.payload.decode() == 'online':
-        send_config_message(client)
-    elif message.payload.decode() == "display_on":
-        reading = subprocess.check_output([vcgencmd, "display_power", "1"]).decode("UTF-8")
-        update_sensors()
-    elif message.payload.decode() == "display_off":
-        reading = subprocess.check_output([vcgencmd, "display_power", "0"]).decode("UTF-8")
+        schedule_rediscovery()
+    elif message.payload.decode() in ["display_on", "display_off"]:
+        power = "1" if message.payload.decode() == "display_on" else "0"
+        if event_loop is not None:
+            # Runs on the event loop, which the command and a sensor update must not block
+            asyncio.run_coroutine_threadsafe(set_display_power_async(power), event_loop)
+            return
+        reading = subprocess.check_output([vcgencmd, "display_power", power]).decode("UTF-8")
         update_sensors()
 
 
+async def run_async():
+    """Single event loop runtime, serving the broker socket, the sensor schedule and signals."""
+    global manager, job, event_loop, async_update_lock
+    loop = event_loop = asyncio.get_running_loop()
+    async_update_lock = asyncio.Lock()
+    stopped = asyncio.Event()
+
+    def refresh():
+        write_message_to_console('Refreshing static sensors')
+        # A coroutine, a refresh on the worker pool would wait for reads queued behind itself
+        loop.create_task(refresh_static_sensors_async())
+
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    loop.add_signal_handler(signal.SIGINT, stopped.set)
+    loop.add_signal_handler(signal.SIGHUP, refresh)
+    sockets = LoopSockets(loop, mqttClient)
+
+    # Start sampling right away, messages taken before the broker is reachable are spooled or queued
+    try:
+        sample_sensors(list(samplers))
+        await refresh_static_sensors_async()
+        await update_sensors_async()
+    except Exception as e:
+        write_message_to_console('Error while attempting to perform inital sensor update: ' + str(e))
+        return
+    if settings['report_timings']:
+        report_startup()
+
+    job = Scheduler(execute=update_sensors_async)
+    for sensor in periodic_sensors():
+        job.add(sensor, get_sensor_interval(sensor))
+    tasks = [loop.create_task(job.run_async())]
+    if settings['guests']['enabled']:
+        guest_job = Scheduler(execute=lambda due: loop.run_in_executor(executor, update_guests, due))
+        guest_job.add('guests', settings['guests']['interval'])
+        tasks.append(loop.create_task(guest_job.run_async()))
+    if samplers:
+        sample_job = Scheduler(execute=lambda due: loop.run_in_executor(executor, sample_sensors, due))
+        for sensor in samplers:
+            sample_job.add(sensor, get_sensor_option(sensor, 'sample_interval', None))
+        tasks.append(loop.create_task(sample_job.run_async()))
+
+    manager = ConnectionManager(mqttClient, settings['mqtt']['hostname'], settings['mqtt']['port'],
+                                settings['mqtt']['reconnect_min'], settings['mqtt']['reconnect_max'])
+    tasks.append(loop.create_task(manager.run_async(sockets)))
+
+    await stopped.wait()
+    write_message_to_console('Program killed: running cleanup code')
+    manager.stopped.set()
+    mqttClient.publish(f'system-sensors/sensor/{devicename}/availability', 'offline', retain=True)
+    mqttClient.disconnect()
+    try:
+        # The socket closes once the offline message and the disconnect went out
+        await asyncio.wait_for(sockets.closed.wait(), 5)
+    except asyncio.TimeoutError:
+        pass
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if executor is not None:
+        executor.shutdown(wait=False)
+    if spool is not None:
+        spool.close()
+
+
 if __name__ == '__main__':
     try:
         args = _parser().parse_args()
@@ -248,18 +1393,34 @@ if __name__ == '__main__':
     check_settings(settings)
 
     add_drives()
+    add_interfaces_and_disks()
+    add_hwmon_sensors()
+    add_sampled_sensors()
+    if settings['self_metrics']:
+        add_self_metrics()
 
     devicename = settings['devicename'].replace(' ', '').lower()
     deviceNameDisplay = settings['devicename']
-    deviceManufacturer = "RPI Foundation" if "rasp" in OS_DATA["ID"] else OS_DATA['NAME']
+    deviceManufacturer = "RPI Foundation" if "rasp" in get_os_data()["ID"] else get_os_data()['NAME']
     deviceModel = get_host_model()
     ha_status = settings['ha_status']
-    
+    set_updates_max_age(get_sensor_option('updates', 'max_age', 86400))
+    if sensor_enabled('updates'):
+        # Start counting in the background right away, the sensor only reads the cached count
+        get_updates()
+    discovery_limiter = TokenBucket(settings['discovery_rate'], max(1, settings['discovery_rate']))
+    if settings['spool']['enabled']:
+        spool_path = settings['spool'].get('path') or path.join(path.dirname(path.abspath(settings_file)), 'system_sensors.spool')
+        spool = Spool(spool_path, settings['spool']['size'])
+        if len(spool):
+            write_message_to_console(f'Found {len(spool)} bytes of spooled messages in {spool_path}')
+    if settings['workers'] > 0:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers'], thread_name_prefix='sensor')
 
     # https://eclipse.dev/paho/files/paho.mqtt.python/html/migrations.html
     # note that with version1, mqttv3 is used and no other migration is made
     # if paho-mqtt v1.6.x gets removed, a full code migration must be made
-    if importlib.metadata.version("paho-mqtt")[0] == '1':
+    if not hasattr(mqtt, 'CallbackAPIVersion'):
        # for paho 1.x clients
        mqttClient = mqtt.Client(client_id=settings['client_id'])
     else:
@@ -269,6 +1430,9 @@ if __name__ == '__main__':
 
     mqttClient.on_connect = on_connect                      #attach function to callback
     mqttClient.on_message = on_message
+    mqttClient.on_disconnect = on_disconnect
+    mqttClient.on_publish = on_publish
+    outbound = OutboundQueue(mqttClient, settings['outbound']['max_inflight'], settings['outbound']['max_queued'])
     mqttClient.will_set(f'system-sensors/sensor/{devicename}/availability', 'offline', retain=True)
     if 'user' in settings['mqtt']:
         mqttClient.username_pw_set(
@@ -281,48 +1445,77 @@ if __name__ == '__main__':
         ca_certs=settings['tls']['ca_certs'], certfile=settings['tls']['certfile'], keyfile=settings['tls']['keyfile']
       )
 
+    if settings['prometheus']['enabled']:
+        from metrics import MetricsServer
+        metrics_server = MetricsServer(settings['prometheus']['address'], settings['prometheus']['port'], refresh_metrics,
+                                       lambda: last_collection, get_metric_families, settings['prometheus']['max_age'])
+        threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+
+    if settings['runtime'] == 'asyncio':
+        import asyncio
+        asyncio.run(run_async())
+        exit()
+
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGHUP, refresh_handler)
 
-    while True:
-        try:
-            mqttClient.connect(settings['mqtt']['hostname'], settings['mqtt']['port'])
-            break
-        except ConnectionRefusedError:
-            # sleep for 2 minutes if broker is unavailable and retry.
-            # Make this value configurable?
-            # this feels like a dirty hack. Is there some other way to do this?
-            time.sleep(120)
-        except OSError:
-            # sleep for 10 minutes if broker is not reachable, i.e. network is down
-            # Make this value configurable?
-            # this feels like a dirty hack. Is there some other way to do this?
-            time.sleep(600)
-    try:
-        send_config_message(mqttClient)
-    except Exception as e:
-        write_message_to_console('Error while attempting to send config to MQTT host: ' + str(e))
-        exit()
+    # Start sampling right away, messages taken before the broker is reachable are spooled or queued
     try:
+        sample_sensors(list(samplers))
+        refresh_static_sensors()
         update_sensors()
     except Exception as e:
         write_message_to_console('Error while attempting to perform inital sensor update: ' + str(e))
         exit()
+    if settings['report_timings']:
+        report_startup()
 
-    job = Job(interval=dt.timedelta(seconds=poll_interval), execute=update_sensors)
+    job = Scheduler(execute=update_sensors)
+    for sensor in periodic_sensors():
+        job.add(sensor, get_sensor_interval(sensor))
     job.start()
+    guest_job = None
+    if settings['guests']['enabled']:
+        guest_job = Scheduler(execute=update_guests)
+        guest_job.add('guests', settings['guests']['interval'])
+        guest_job.start()
+    sample_job = None
+    if samplers:
+        sample_job = Scheduler(execute=sample_sensors)
+        for sensor in samplers:
+            sample_job.add(sensor, get_sensor_option(sensor, 'sample_interval', None))
+        sample_job.start()
 
-    mqttClient.loop_start()
+    manager = ConnectionManager(mqttClient, settings['mqtt']['hostname'], settings['mqtt']['port'],
+                                settings['mqtt']['reconnect_min'], settings['mqtt']['reconnect_max'])
+    manager.start()
 
     while True:
         try:
             sys.stdout.flush()
+            if static_refresh.is_set():
+                static_refresh.clear()
+                write_message_to_console('Refreshing static sensors')
+                refresh_static_sensors()
             time.sleep(1)
         except ProgramKilled:
+            # Another SIGTERM or Ctrl-C must not cut the cleanup short and leave the schedulers running
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
             write_message_to_console('Program killed: running cleanup code')
             mqttClient.publish(f'system-sensors/sensor/{devicename}/availability', 'offline', retain=True)
-            mqttClient.disconnect()
-            mqttClient.loop_stop()
+            manager.stop()
             sys.stdout.flush()
             job.stop()
+            if guest_job is not None:
+                guest_job.stop()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+            if sample_job is not None:
+                sample_job.stop()
+            if executor is not None:
+                executor.shutdown(wait=False)
+            if spool is not None:
+                spool.close()
             break
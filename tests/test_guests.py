@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sensors
+import guests
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def add_guest(cgroup):
+    write(os.path.join(cgroup, 'cpu.stat'), 'usage_usec 1000000\nuser_usec 600000\nsystem_usec 400000\n')
+    write(os.path.join(cgroup, 'memory.current'), '104857600\n')
+    write(os.path.join(cgroup, 'memory.max'), '536870912\n')
+    write(os.path.join(cgroup, 'io.stat'), '8:0 rbytes=4096 wbytes=8192 rios=1 wios=2 dbytes=0 dios=0\n')
+
+class GuestLifecycleTest(unittest.TestCase):
+    """Guests read from a fake cgroup v2 tree release their files and rates once they stop."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.container = os.path.join(self.root, 'lxc', '101')
+        self.vm = os.path.join(self.root, 'qemu.slice', '102.scope')
+        add_guest(self.container)
+        add_guest(self.vm)
+
+    def open_fds(self):
+        return len(os.listdir('/proc/self/fd'))
+
+    def readers(self, cgroup):
+        return [path for path in sensors.file_readers if path.startswith(cgroup + '/')]
+
+    def test_stopped_guest_releases_files_and_rates(self):
+        fds = self.open_fds()
+        collected = guests.collect_guests(self.root)
+        self.assertEqual({'101': 'lxc', '102': 'qemu'}, {guest: kind for guest, (kind, values) in collected.items()})
+        self.assertEqual(4, len(self.readers(self.container)))
+        self.assertEqual(fds + 8, self.open_fds())
+        self.assertIn('101', guests.guest_rates.index)
+
+        shutil.rmtree(self.container)
+        collected = guests.collect_guests(self.root)
+        self.assertEqual(['102'], list(collected))
+        self.assertEqual([], self.readers(self.container))
+        self.assertEqual(4, len(self.readers(self.vm)))
+        self.assertEqual(fds + 4, self.open_fds())
+        self.assertNotIn('101', guests.guest_rates.index)
+        self.assertIn('102', guests.guest_rates.index)
+
+        shutil.rmtree(self.vm)
+        self.assertEqual({}, guests.collect_guests(self.root))
+        self.assertEqual(fds, self.open_fds())
+        self.assertEqual([], list(guests.guest_rates.index))
+
+if __name__ == '__main__':
+    unittest.main()